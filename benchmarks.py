@@ -0,0 +1,821 @@
+import os
+os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+import io
+import sys
+import gzip
+import json
+import time
+import tempfile
+import threading
+import tracemalloc
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import charts
+import yandex_bot_start as bot_module
+
+BENCHMARKS = {}
+DEFAULT_SIZES = [1000, 100000, 1000000]
+# Размеры сверх стандартных для бенчмарков, у которых есть обещание на большом объёме
+EXTRA_SIZES = {}
+
+
+class MemoryS3:
+	# Бакет в памяти вместо Object Storage, чтобы бенчмарки не ходили в сеть
+	class NoSuchKey(Exception):
+		pass
+
+	def __init__(self):
+		self.objects = {}
+		self.exceptions = self
+
+	def put_object(self, Bucket, Key, Body, **kwargs):
+		self.objects[Key] = (Body.encode("utf-8") if isinstance(Body, str) else Body, kwargs.get("ContentEncoding"))
+
+	def get_object(self, Bucket, Key, **kwargs):
+		if Key not in self.objects:
+			raise self.NoSuchKey(Key)
+		body, encoding = self.objects[Key]
+		return {"Body": io.BytesIO(body), "ContentEncoding": encoding}
+
+
+def use_memory_s3():
+	s3 = MemoryS3()
+	bot_module.s3_client = s3
+	return s3
+
+
+def benchmark(name, extra_sizes=()):
+	def decorator(func):
+		BENCHMARKS[name] = func
+		EXTRA_SIZES[name] = list(extra_sizes)
+		return func
+	return decorator
+
+
+def expect(condition, message):
+	# Граница, которую обещает реализация: её нарушение – провал бенчмарка, а не просто другое число
+	if not condition:
+		raise AssertionError(message)
+
+
+def measure(func, repeat=3):
+	best = float("inf")
+	for _ in range(repeat):
+		started = time.perf_counter()
+		func()
+		best = min(best, time.perf_counter() - started)
+	return best
+
+
+def make_users(n, seed=0):
+	rng = np.random.default_rng(seed)
+	df = pd.DataFrame({
+		"user_id": np.arange(100000, 100000 + n),
+		"gender": rng.choice(["m", "f"], n),
+		"weight": rng.uniform(45, 120, n).round(1),
+		"height": rng.integers(150, 200, n),
+		"age": rng.integers(16, 80, n),
+		"activity": rng.integers(0, 120, n),
+		"city": rng.choice(["Москва", "Казань", "Пятигорск", "Самара"], n),
+		"calorie_mode": rng.choice(["auto", "manual"], n, p=[0.8, 0.2]),
+		"calorie_goal": rng.integers(1500, 3500, n),
+		"water_goal": 0.0,
+		"logged_water": rng.integers(0, 3000, n),
+		"logged_calories": rng.uniform(0, 3000, n).round(1),
+		"burned_calories": rng.integers(0, 800, n),
+		"last_reset_date": "2026-01-14",
+	})
+	df["water_goal"] = df["weight"] * 30
+	return df
+
+
+@benchmark("recompute_goals")
+def bench_recompute_goals(size):
+	df = bot_module.index_users(make_users(size))
+	vectorized = measure(lambda: bot_module.recompute_goals(df.copy(), dry_run=True))
+
+	# Скалярный путь меряем на части таблицы и пересчитываем на весь размер
+	sample = df.head(min(size, 10000))
+	def scalar():
+		for row in sample.itertuples():
+			bmr = bot_module.calculate_bmr(row.gender, row.weight, row.height, row.age)
+			int(bmr * bot_module.activity_multiplier(row.activity))
+			bot_module.water_norm(row.weight)
+	scalar_time = measure(scalar, repeat=1) * size / len(sample)
+
+	# Старые записи без calorie_mode: при переносе цель по формуле помечается auto, остальные manual,
+	# а после изменения формулы автоматические цели должны пересчитаться
+	legacy = df.copy()
+	legacy["calorie_mode"] = None
+	calories, _ = bot_module.calculate_goals_bulk(legacy)
+	formula = legacy.index[: size // 2]
+	legacy.loc[formula, "calorie_goal"] = calories[: size // 2].astype(int)
+	bot_module.infer_calorie_modes(legacy)
+	expect((legacy.loc[formula, "calorie_mode"] == "auto").all(), "цель по формуле не помечена auto")
+	original_bulk = bot_module.calculate_goals_bulk
+	bot_module.calculate_goals_bulk = lambda frame: (original_bulk(frame)[0] + 100, original_bulk(frame)[1])
+	try:
+		diff = bot_module.recompute_goals(legacy)
+	finally:
+		bot_module.calculate_goals_bulk = original_bulk
+	recomputed = set(diff.loc[diff["calorie_goal"] != diff["old_calorie_goal"], "user_id"])
+	expected = set(legacy.index[(legacy["calorie_mode"] == "auto").to_numpy()])
+	expect(recomputed == expected, f"после смены формулы пересчитано {len(recomputed)} целей из {len(expected)}")
+
+	return {"vectorized_s": vectorized, "scalar_estimate_s": scalar_time, "legacy_recomputed": len(recomputed)}
+
+
+def make_water_log(n, seed=0):
+	rng = np.random.default_rng(seed)
+	start = np.datetime64("2026-01-01T08:00:00")
+	return pd.DataFrame({
+		"user_id": rng.integers(100000, 100000 + max(n // 20, 1), n),
+		"datetime": (start + np.sort(rng.integers(0, 90 * 86400 * 10**6, n)).astype("timedelta64[us]")).astype(str),
+		"amount_ml": rng.choice([150, 200, 250, 300, 330, 500], n),
+	})
+
+
+@benchmark("s3_compression")
+def bench_s3_compression(size):
+	raw = make_water_log(size).to_csv(index=False).encode("utf-8")
+	result = {"raw_bytes": len(raw)}
+
+	codecs = {"gzip": (lambda data: gzip.compress(data, compresslevel=6), gzip.decompress)}
+	if bot_module.zstandard is not None:
+		zstd = bot_module.zstandard
+		codecs["zstd"] = (zstd.ZstdCompressor(level=3).compress, zstd.ZstdDecompressor().decompress)
+
+	for name, (compress, decompress) in codecs.items():
+		packed = compress(raw)
+		result[f"{name}_bytes"] = len(packed)
+		result[f"{name}_ratio"] = len(raw) / len(packed)
+		result[f"{name}_compress_s"] = measure(lambda: compress(raw))
+		result[f"{name}_decompress_s"] = measure(lambda: decompress(packed))
+	return result
+
+
+EXPORT_PEAK_MB = 32
+
+
+# Выгрузка обещает память, не зависящую от размера журнала, в том числе на 5 млн строк
+@benchmark("export", extra_sizes=[5000000])
+def bench_export(size):
+	# size – число строк в журнале воды; у выгружаемого пользователя примерно 1% строк
+	s3 = use_memory_s3()
+	packed = io.BytesIO()
+	expected = 0
+	with gzip.GzipFile(fileobj=packed, mode="wb", compresslevel=1) as archive:
+		for start in range(0, size, 500000):
+			chunk = make_water_log(min(500000, size - start), seed=start)
+			chunk.loc[chunk.index % 100 == 0, "user_id"] = 42
+			expected += int((chunk.index % 100 == 0).sum())
+			archive.write(chunk.to_csv(index=False, header=start == 0).encode("utf-8"))
+	s3.objects[bot_module.WATER_LOG_CSV] = (packed.getvalue(), "gzip")
+
+	tracemalloc.start()
+	started = time.perf_counter()
+	with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as out:
+		rows = bot_module.export_user_history(42, out)
+	elapsed = time.perf_counter() - started
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	# Журнал читается кусками по EXPORT_CHUNK_ROWS строк, поэтому пик памяти не растёт с размером журнала
+	expect(rows == expected, f"выгружено {rows} строк вместо {expected}")
+	expect(peak < EXPORT_PEAK_MB * 2**20, f"пик памяти {peak / 2**20:.1f} МБ больше {EXPORT_PEAK_MB} МБ")
+	return {"rows": rows, "export_s": elapsed, "peak_mb": peak / 2**20, "object_mb": len(packed.getvalue()) / 2**20}
+
+
+def make_catalog(n, seed=0):
+	rng = np.random.default_rng(seed)
+	words = ["суп", "салат", "каша", "рагу", "котлета", "запеканка", "омлет", "паста", "плов", "пирог"]
+	extras = ["с курицей", "с грибами", "овощной", "из тыквы", "с сыром", "на пару", "домашний", "с рисом"]
+	names = [
+		f"{words[i % len(words)]} {extras[(i // len(words)) % len(extras)]} №{i}"
+		for i in range(n)
+	]
+	return pd.DataFrame({
+		"id": np.arange(1, n + 1),
+		"product_name": names,
+		"energy_kcal_100g": rng.integers(20, 600, n),
+	})
+
+
+@benchmark("reference_cold_start")
+def bench_reference_cold_start(size):
+	# Холодный старт: разбор CSV и поиск названия против открытия бандла через mmap
+	import build_bundle
+	from reference_bundle import open_bundle
+
+	with tempfile.TemporaryDirectory() as source:
+		catalog = make_catalog(size)
+		for file_name in build_bundle.TABLES:
+			catalog.rename(columns={"product_name": build_bundle.TABLES[file_name]}).to_csv(
+				os.path.join(source, file_name), index=False
+			)
+		bundle_path = os.path.join(source, "reference.bundle")
+		build_bundle.build(source, bundle_path)
+		query = catalog.product_name.iloc[size // 2].lower()
+
+		def from_csv():
+			df = pd.read_csv(os.path.join(source, "caloric_products.csv"))
+			names = df["product_name"].str.strip().str.lower().tolist()
+			bot_module.get_close_matches(query, names, n=1, cutoff=0.6)
+
+		def from_bundle():
+			open_bundle(bundle_path).table("caloric_products.csv").match(query)
+
+		return {
+			"csv_s": measure(from_csv, repeat=1),
+			"bundle_s": measure(from_bundle, repeat=1),
+			"bundle_mb": os.path.getsize(bundle_path) / 2**20,
+		}
+
+
+def put_csv(s3, file_key, df):
+	bot_module.save_df_to_s3(df, file_key)
+
+
+def make_train_catalog(n, seed=0):
+	catalog = make_catalog(n, seed)
+	rng = np.random.default_rng(seed)
+	return pd.DataFrame({
+		"id": catalog.id,
+		"train_type": catalog.product_name,
+		"calorie_consumption": rng.integers(150, 900, n),
+		"water_train": rng.integers(200, 800, n),
+		"water_add_heat": rng.integers(100, 400, n),
+	})
+
+
+def use_csv_references(s3):
+	# Справочники из CSV в бакете: бандл проверяется отдельно в reference_cold_start
+	bot_module.reference_bundle = None
+	bot_module.reference_cache.clear()
+
+
+@benchmark("food_lookup")
+def bench_food_lookup(size):
+	s3 = use_memory_s3()
+	use_csv_references(s3)
+	catalog = make_catalog(size)
+	put_csv(s3, bot_module.FOOD_CSV, catalog)
+	queries = [catalog.product_name.iloc[i].lower() for i in np.linspace(0, size - 1, 5).astype(int)]
+
+	def cold():
+		bot_module.reference_cache.clear()
+		bot_module.get_food_from_csv(queries[0])
+
+	cold_s = measure(cold, repeat=1)
+	warm_s = measure(lambda: [bot_module.get_food_from_csv(query) for query in queries], repeat=1) / len(queries)
+	return {"cold_s": cold_s, "warm_lookup_s": warm_s}
+
+
+@benchmark("workout_match")
+def bench_workout_match(size):
+	# То же, что делает /log_workout до запроса погоды: поиск тренировки и расчёт калорий и воды
+	s3 = use_memory_s3()
+	use_csv_references(s3)
+	catalog = make_train_catalog(size)
+	put_csv(s3, bot_module.TRAIN_CSV, catalog)
+	queries = [catalog.train_type.iloc[i].lower() for i in np.linspace(0, size - 1, 5).astype(int)]
+
+	def match(query, minutes=45):
+		train_df = bot_module.load_reference(bot_module.TRAIN_CSV)
+		row_number = bot_module.match_reference(bot_module.TRAIN_CSV, "train_type", query)
+		train = train_df.iloc[row_number if row_number is not None else 0]
+		return int(train.calorie_consumption * minutes / 60), int(train.water_train * minutes / 60)
+
+	def cold():
+		bot_module.reference_cache.clear()
+		match(queries[0])
+
+	cold_s = measure(cold, repeat=1)
+	warm_s = measure(lambda: [match(query) for query in queries], repeat=1) / len(queries)
+	return {"cold_s": cold_s, "warm_match_s": warm_s}
+
+
+def store_users(s3, size):
+	# Объект пользователя читается по ключу, поэтому время не зависит от числа пользователей;
+	# в бакет кладём не больше 2000 объектов, чтобы не тратить время на подготовку
+	users = make_users(min(size, 2000))
+	users["user_id"] = users["user_id"].astype(str)
+	records = users.to_dict("records")
+	for record in records:
+		bot_module.save_user(record)
+	return records
+
+
+@benchmark("reset_daily")
+def bench_reset_daily(size):
+	s3 = use_memory_s3()
+	records = store_users(s3, size)
+	ids = [record["user_id"] for record in records]
+	first = measure(lambda: [bot_module.reset_daily_if_needed(user_id) for user_id in ids], repeat=1)
+	# Повторный вызов в тот же день ничего не записывает
+	again = measure(lambda: [bot_module.reset_daily_if_needed(user_id) for user_id in ids], repeat=1)
+	return {"reset_per_user_s": first / len(ids), "noop_per_user_s": again / len(ids)}
+
+
+@benchmark("save_user")
+def bench_save_user(size):
+	s3 = use_memory_s3()
+	records = store_users(s3, size)
+	for record in records:
+		bot_module.advance_trends(record, "2026-01-15")
+	elapsed = measure(lambda: [bot_module.save_user(record) for record in records])
+	return {"save_per_user_s": elapsed / len(records)}
+
+
+def make_food_log(n, seed=0):
+	log = make_water_log(n, seed).rename(columns={"amount_ml": "calories"})
+	log["calories"] = np.random.default_rng(seed).uniform(20, 800, n).round(1)
+	return log
+
+
+@benchmark("append_logs")
+def bench_append_logs(size):
+	# size – число строк, уже лежащих в журнале; добавляем по одной записи, как команды бота
+	s3 = use_memory_s3()
+	put_csv(s3, bot_module.WATER_LOG_CSV, make_water_log(size))
+	put_csv(s3, bot_module.FOOD_LOG_CSV, make_food_log(size))
+	return {
+		"append_water_s": measure(lambda: bot_module.append_water_log(42, 250), repeat=1),
+		"append_food_s": measure(lambda: bot_module.append_food_log(42, 320.5), repeat=1),
+		"water_object_mb": len(s3.objects[bot_module.WATER_LOG_CSV][0]) / 2**20,
+	}
+
+
+@benchmark("stats")
+def bench_stats(size):
+	# Подготовка данных для /stats по журналу из size строк и рендер одного графика
+	s3 = use_memory_s3()
+	log = make_water_log(size)
+	today = pd.Timestamp.now().normalize()
+	mine = pd.DataFrame({
+		"user_id": 42,
+		"datetime": (today + pd.to_timedelta(np.arange(12) * 3600 + 8 * 3600, unit="s")).strftime("%Y-%m-%dT%H:%M:%S.%f"),
+		"amount_ml": 250,
+	})
+	put_csv(s3, bot_module.WATER_LOG_CSV, pd.concat([log, mine], ignore_index=True))
+
+	series = bot_module.today_series(bot_module.WATER_LOG_CSV, 42, "amount_ml")
+	chart_args = (*series, 2400.0, "Прогресс выпитой воды за день", "Приёмы воды", "мл", "мл")
+	return {
+		"prep_s": measure(lambda: bot_module.today_series(bot_module.WATER_LOG_CSV, 42, "amount_ml"), repeat=1),
+		"render_s": measure(lambda: charts.render_chart(*chart_args)),
+		"points": len(series[0]),
+	}
+
+
+@benchmark("tip_index")
+def bench_tip_index(size):
+	# size – число блюд в health_food.csv; подбор для /tip по индексу против выборки по всей таблице
+	catalog = make_catalog(size)
+	build_s = measure(lambda: bot_module.build_tip_index(catalog), repeat=1)
+	index = bot_module.build_tip_index(catalog)
+	deltas = np.random.default_rng(0).uniform(50, 2500, 200)
+
+	def pick():
+		for i, delta in enumerate(deltas):
+			bot_module.pick_tips(index, delta, f"{i}:2026-01-15", i % 5)
+
+	def scan():
+		for delta in deltas[:20]:
+			portions = catalog.energy_kcal_100g.to_numpy()[:, None] * bot_module.PORTION_PRESETS / 100
+			np.argwhere((portions <= delta) & (portions >= delta * bot_module.TIP_MIN_SHARE))
+
+	return {
+		"build_s": build_s,
+		"pick_s": measure(pick) / len(deltas),
+		"scan_s": measure(scan, repeat=1) / 20,
+	}
+
+
+@benchmark("breaker_outage")
+def bench_breaker_outage(size):
+	# Имитация отказа OpenFoodFacts: каждый запрос висит до таймаута (OUTAGE_DELAY вместо 10 с).
+	# Сравниваем время get_food_info без размыкателя и с ним; size – число запросов, но не больше 200
+	import requests
+	from breaker import CircuitBreaker
+
+	calls = min(size, 200)
+	outage_delay = 0.05
+
+	def hanging_get(url, timeout=None, **kwargs):
+		time.sleep(outage_delay)
+		raise requests.exceptions.Timeout(url)
+
+	def run(breaker):
+		bot_module.breakers["openfoodfacts"] = breaker
+		latencies = []
+		for i in range(calls):
+			started = time.perf_counter()
+			bot_module.cached_food_info(f"продукт {size}-{i}")
+			latencies.append(time.perf_counter() - started)
+		return np.array(latencies)
+
+	original_get, original_breaker = bot_module.requests.get, bot_module.breakers["openfoodfacts"]
+	bot_module.requests.get = hanging_get
+	try:
+		bot_module.food_cache.clear()
+		without = run(CircuitBreaker("off", min_calls=10**9))
+		bot_module.food_cache.clear()
+		breaker = CircuitBreaker("off", open_seconds=60)
+		with_breaker = run(breaker)
+	finally:
+		bot_module.requests.get = original_get
+		bot_module.breakers["openfoodfacts"] = original_breaker
+
+	# До таймаута ждут только вызовы, по которым размыкатель набирает статистику, остальные сразу идут в запасной вариант
+	slow_calls = int((with_breaker >= outage_delay).sum())
+	open_p99 = float(np.percentile(with_breaker[breaker.min_calls:], 99)) if calls > breaker.min_calls else 0.0
+	expect(slow_calls <= breaker.min_calls, f"до таймаута ждали {slow_calls} вызовов, размыкатель должен открыться после {breaker.min_calls}")
+	expect(open_p99 < outage_delay / 10, f"p99 при открытом размыкателе {open_p99 * 1000:.1f} мс")
+	return {
+		"without_total_s": float(without.sum()),
+		"without_p99_s": float(np.percentile(without, 99)),
+		"breaker_total_s": float(with_breaker.sum()),
+		"breaker_p50_s": float(np.percentile(with_breaker, 50)),
+		"breaker_p99_s": float(np.percentile(with_breaker, 99)),
+		"breaker_open_p99_s": open_p99,
+		"slow_calls": slow_calls,
+	}
+
+
+class TooManyRequests(Exception):
+	error_code = 429
+
+	def __init__(self, retry_after):
+		super().__init__("Too Many Requests")
+		self.result_json = {"parameters": {"retry_after": retry_after}}
+
+
+class FakeSendApi:
+	# Поддельный Bot API для очереди отправки: запоминает время каждой отправки, на fail_at-м запросе отвечает 429
+	def __init__(self, fail_at, retry_after):
+		self.fail_at = fail_at
+		self.retry_after = retry_after
+		self.calls = 0
+		self.failed_at = None
+		self.sent = []
+		self.lock = threading.Lock()
+
+	def send_message(self, chat_id, text, **kwargs):
+		with self.lock:
+			self.calls += 1
+			if self.calls == self.fail_at:
+				self.failed_at = time.perf_counter()
+				raise TooManyRequests(self.retry_after)
+			self.sent.append((time.perf_counter(), chat_id, text))
+
+
+@benchmark("send_queue")
+def bench_send_queue(size):
+	# Очередь отправки против поддельного API: size сообщений (не больше 400) в 20 чатов, посередине API отвечает 429.
+	# Проверяем общий лимит, паузу на retry_after и порядок сообщений внутри чата
+	from send_queue import SendQueue
+
+	count = min(size, 400)
+	rate, retry_after, chats = 100.0, 0.2, 20
+	api = FakeSendApi(fail_at=count // 2, retry_after=retry_after)
+	outbound = SendQueue(api, workers=4, global_rate=rate, chat_rate=rate, chat_burst=3)
+	started = time.perf_counter()
+	for i in range(count):
+		outbound.send_message(i % chats, i)
+	expect(outbound.drain(60), "очередь не опустела за 60 с")
+	elapsed = time.perf_counter() - started
+	stats = outbound.stats()
+
+	expect(stats["sent"] == count and stats["failed"] == 0, f"отправлено {stats['sent']} из {count}, ошибок {stats['failed']}")
+	expect(stats["retried"] == (1 if api.failed_at else 0), f"повторов {stats['retried']}")
+	for chat_id in range(chats):
+		texts = [text for _, chat, text in api.sent if chat == chat_id]
+		expect(texts == sorted(texts), f"нарушен порядок сообщений в чате {chat_id}")
+	# Общая корзина вмещает rate сообщений, дальше не быстрее rate в секунду (запрос с 429 тоже тратит токен)
+	min_elapsed = (count + 1 - rate) / rate
+	expect(elapsed >= min_elapsed * 0.95, f"{count} сообщений за {elapsed:.2f} с, быстрее общего лимита")
+	pause = 0.0
+	if api.failed_at is not None:
+		pause = min(sent_at for sent_at, _, _ in api.sent if sent_at > api.failed_at) - api.failed_at
+		expect(pause >= retry_after * 0.95, f"после 429 следующая отправка через {pause * 1000:.0f} мс")
+	return {"elapsed_s": elapsed, "sent_per_s": count / elapsed, "pause_after_429_s": pause}
+
+
+def render_jobs(jobs, points, workers):
+	rng = np.random.default_rng(0)
+	args = [
+		(np.arange(points) * 600 + 8 * 3600, np.cumsum(rng.integers(100, 500, points)), 2000.0,
+			"Прогресс выпитой воды за день", "Приёмы воды", "мл", "мл")
+		for _ in range(jobs)
+	]
+	if workers == 0:
+		for chart_args in args:
+			charts.render_chart(*chart_args)
+		return
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		list(pool.map(charts.render_chart, *zip(*args)))
+
+
+@benchmark("stats_render")
+def bench_stats_render(size):
+	# Пропускная способность /stats: графики в потоке обработчика против пула процессов.
+	# size – число точек на графике, но не больше 500: за день столько записей не бывает
+	points = min(size, 500)
+	jobs = 32
+	result = {"inline_charts_per_s": jobs / measure(lambda: render_jobs(jobs, points, 0), repeat=1)}
+	for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+		if workers <= (os.cpu_count() or 1):
+			elapsed = measure(lambda: render_jobs(jobs, points, workers), repeat=1)
+			result[f"pool{workers}_charts_per_s"] = jobs / elapsed
+	return result
+
+
+@benchmark("throttle")
+def bench_throttle(size):
+	# Проверка лимита на каждую команду: время take() и память корзин, когда активны size пользователей
+	from throttle import Throttle
+
+	# Общий лимит снят, иначе корзины появились бы только у первых пользователей
+	now = [0.0]
+	throttle = Throttle(limits={"render": {"user": (0.05, 2), "global": (1e9, 1e9)}}, clock=lambda: now[0])
+	users = np.arange(size)
+	tracemalloc.start()
+	for user_id in users.tolist():
+		throttle.take(user_id, "render")
+	memory, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	calls = min(size, 100000)
+	def take():
+		for user_id in users[:calls].tolist():
+			now[0] += 0.001
+			throttle.take(user_id, "render")
+	return {
+		"take_s": measure(take, repeat=1) / calls,
+		"bytes_per_user": memory / size,
+	}
+
+
+class FakeTelegram:
+	# Поддельный Bot API для index.py: отдаёт заготовленные обновления в getUpdates
+	# и считает ответы бота (sendMessage, sendPhoto)
+	def __init__(self):
+		from collections import deque
+		from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+		from urllib.parse import urlparse, parse_qs
+
+		self.pending = deque()
+		self.polled = threading.Event()
+		self.released = threading.Event()
+		self.sent = 0
+		self.done = threading.Event()
+		self.expected = 0
+		self.lock = threading.Lock()
+		fake = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				self.answer()
+
+			def do_POST(self):
+				self.rfile.read(int(self.headers.get("Content-Length") or 0))
+				self.answer()
+
+			def answer(self):
+				url = urlparse(self.path)
+				method = url.path.rsplit("/", 1)[-1]
+				params = parse_qs(url.query)
+				if method == "getUpdates":
+					fake.polled.set()
+					result = []
+					if fake.released.is_set():
+						with fake.lock:
+							while fake.pending and len(result) < 100:
+								result.append(fake.pending.popleft())
+					if not result:
+						time.sleep(0.05)
+				elif method == "getMe":
+					result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+				else:
+					chat_id = int(params.get("chat_id", ["0"])[0])
+					result = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}}
+					if method.startswith("send"):
+						with fake.lock:
+							fake.sent += 1
+							if fake.sent >= fake.expected:
+								fake.done.set()
+				body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		class Server(ThreadingHTTPServer):
+			daemon_threads = True
+
+			def handle_error(self, request, client_address):
+				# Бот завершается посреди getUpdates – оборванные соединения не интересны
+				pass
+
+		self.server = Server(("127.0.0.1", 0), Handler)
+		self.port = self.server.server_address[1]
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def expect(self, count):
+		self.sent = 0
+		self.expected = count
+		self.done.clear()
+
+
+def free_port():
+	import socket
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+
+def make_updates(count, users):
+	commands = ["/help", "/log_water 250", "/check_progress"]
+	updates = []
+	for i in range(count):
+		user_id = int(users[i % len(users)])
+		updates.append({
+			"update_id": i + 1,
+			"message": {
+				"message_id": i + 1, "date": 0, "text": commands[i % len(commands)],
+				"chat": {"id": user_id, "type": "private"},
+				"from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+				"entities": [{"type": "bot_command", "offset": 0, "length": len(commands[i % len(commands)].split()[0])}],
+			},
+		})
+	return updates
+
+
+def start_index_bot(workdir, fake, **env):
+	import subprocess
+	env = {
+		**os.environ,
+		"TELEGRAM_TOKEN": "0:bench",
+		"TELEGRAM_API_URL": f"http://127.0.0.1:{fake.port}/bot{{0}}/{{1}}",
+		"STATE_DIR": os.path.join(workdir, "state"),
+		"CHART_WORKERS": "1",
+		# Бенчмарк шлёт много команд от одного пользователя – лимит частоты здесь не нужен
+		"THROTTLE_CHEAP_USER": "1000,1000",
+		**env,
+	}
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.py")
+	return subprocess.Popen([sys.executable, script], cwd=workdir, env=env,
+		stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for_port(port, timeout=60):
+	import socket
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		try:
+			socket.create_connection(("127.0.0.1", port), timeout=1).close()
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError(f"порт {port} не открылся")
+
+
+def run_polling(workdir, fake, updates):
+	process = start_index_bot(workdir, fake, BOT_MODE="polling")
+	try:
+		# Отсчёт начинается, когда бот уже загрузился и спрашивает getUpdates
+		fake.polled.wait(60)
+		fake.expect(len(updates))
+		fake.pending.extend(updates)
+		started = time.perf_counter()
+		fake.released.set()
+		fake.done.wait(300)
+		return time.perf_counter() - started
+	finally:
+		fake.released.clear()
+		process.terminate()
+		process.wait()
+
+
+def run_webhook(workdir, fake, updates, workers, clients=16):
+	import requests
+	from concurrent.futures import ThreadPoolExecutor
+
+	port = free_port()
+	process = start_index_bot(workdir, fake, BOT_MODE="webhook", WEBHOOK_HOST="127.0.0.1",
+		WEBHOOK_PORT=str(port), WEBHOOK_WORKERS=str(workers), WEBHOOK_SECRET="bench")
+	try:
+		wait_for_port(port)
+		fake.expect(len(updates))
+		url = f"http://127.0.0.1:{port}/"
+		started = time.perf_counter()
+		with ThreadPoolExecutor(max_workers=clients) as pool:
+			list(pool.map(lambda update: requests.post(url, json=update, timeout=60,
+				headers={"X-Telegram-Bot-Api-Secret-Token": "bench"}), updates))
+		fake.done.wait(300)
+		return time.perf_counter() - started
+	finally:
+		process.terminate()
+		process.wait()
+
+
+@benchmark("webhook_server")
+def bench_webhook_server(size):
+	# index.py против поддельного Telegram: обновлений в секунду при long polling
+	# и во встроенном вебхук-сервере с разным числом процессов. size – число обновлений, но не больше 600
+	from datetime import date
+
+	count = min(size, 600)
+	users = make_users(50)
+	users["last_reset_date"] = date.today().isoformat()
+	updates = make_updates(count, users["user_id"].tolist())
+	fake = FakeTelegram()
+	result = {}
+	try:
+		with tempfile.TemporaryDirectory() as workdir:
+			users.to_csv(os.path.join(workdir, "users.csv"), index=False)
+			result["polling_updates_per_s"] = count / run_polling(workdir, fake, updates)
+			for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+				if workers <= max(os.cpu_count() or 1, 2):
+					elapsed = run_webhook(workdir, fake, updates, workers)
+					result[f"webhook{workers}_updates_per_s"] = count / elapsed
+	finally:
+		fake.server.shutdown()
+	return result
+
+
+def load_baseline(path):
+	with open(path, encoding="utf-8") as f:
+		return json.load(f)
+
+
+def compare(results, baseline, threshold):
+	# Сравниваем только времена (*_s): регрессия – если стало медленнее больше чем на threshold
+	regressions = []
+	for name, sizes in results.items():
+		for size, metrics in sizes.items():
+			old = baseline.get(name, {}).get(size, {})
+			for key, value in metrics.items():
+				if not key.endswith("_s") or not old.get(key):
+					continue
+				ratio = value / old[key]
+				mark = "РЕГРЕССИЯ" if ratio > 1 + threshold else "ok"
+				print(f"{name} [{size}] {key}: {old[key]:.6f} -> {value:.6f} (x{ratio:.2f}) {mark}")
+				if ratio > 1 + threshold:
+					regressions.append((name, size, key))
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Бенчмарки бота на синтетических данных")
+	parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS), help="какие бенчмарки запускать")
+	parser.add_argument("--sizes", nargs="*", type=int,
+		help=f"размеры данных, по умолчанию {DEFAULT_SIZES} и дополнительные размеры отдельных бенчмарков")
+	parser.add_argument("--save", help="сохранить результаты в JSON как базовую линию")
+	parser.add_argument("--compare", help="сравнить с сохранённой базовой линией")
+	parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление, 0.2 = 20%%")
+	args = parser.parse_args(argv)
+
+	results = {}
+	failures = []
+	for name in args.only or sorted(BENCHMARKS):
+		for size in args.sizes or DEFAULT_SIZES + EXTRA_SIZES[name]:
+			try:
+				result = BENCHMARKS[name](size)
+			except AssertionError as e:
+				failures.append((name, size))
+				print(f"{name} [{size}]: ПРОВАЛ – {e}")
+				sys.stdout.flush()
+				continue
+			results.setdefault(name, {})[str(size)] = result
+			metrics = ", ".join(
+				f"{key}={value:.6f}" if isinstance(value, float) else f"{key}={value}"
+				for key, value in result.items()
+			)
+			print(f"{name} [{size}]: {metrics}")
+			sys.stdout.flush()
+
+	if args.save:
+		with open(args.save, "w", encoding="utf-8") as f:
+			json.dump(results, f, ensure_ascii=False, indent=2)
+	if args.compare:
+		regressions = compare(results, load_baseline(args.compare), args.threshold)
+		if regressions:
+			print(f"Регрессий: {len(regressions)}")
+			return 1
+	if failures:
+		print(f"Проваленных проверок: {len(failures)}")
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
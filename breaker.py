@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("bot")
+
+# Размыкатель для внешних API: если в последних WINDOW вызовах слишком много ошибок
+# или медленных ответов, следующие вызовы сразу уходят в запасной вариант, не дожидаясь таймаута
+WINDOW = int(os.environ.get("BREAKER_WINDOW", "20"))
+MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+SLOW_SECONDS = float(os.environ.get("BREAKER_SLOW_SECONDS", "3"))
+SLOW_RATE = float(os.environ.get("BREAKER_SLOW_RATE", "0.5"))
+OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class BreakerOpen(Exception):
+	pass
+
+
+class CircuitBreaker:
+	def __init__(self, name, window=WINDOW, min_calls=MIN_CALLS, error_rate=ERROR_RATE,
+			slow_seconds=SLOW_SECONDS, slow_rate=SLOW_RATE, open_seconds=OPEN_SECONDS,
+			clock=time.monotonic, on_change=None):
+		self.name = name
+		self.min_calls = min_calls
+		self.error_rate = error_rate
+		self.slow_seconds = slow_seconds
+		self.slow_rate = slow_rate
+		self.open_seconds = open_seconds
+		self.clock = clock
+		self.on_change = on_change
+		self.calls = deque(maxlen=window)  # (ошибка, медленно) для последних вызовов
+		self.state = CLOSED
+		self.opened_at = 0.0
+		self.probing = False
+		self.lock = threading.Lock()
+
+	def allow(self):
+		with self.lock:
+			if self.state == OPEN and self.clock() - self.opened_at >= self.open_seconds:
+				self._switch(HALF_OPEN)
+			if self.state == CLOSED:
+				return True
+			# В полуоткрытом состоянии пропускаем ровно один пробный вызов
+			if self.state == HALF_OPEN and not self.probing:
+				self.probing = True
+				return True
+			return False
+
+	def record(self, failed, elapsed):
+		slow = elapsed >= self.slow_seconds
+		with self.lock:
+			if self.state == HALF_OPEN:
+				self.probing = False
+				if failed or slow:
+					self._open()
+				else:
+					self.calls.clear()
+					self._switch(CLOSED)
+				return
+
+			self.calls.append((failed, slow))
+			if self.state == CLOSED and len(self.calls) >= self.min_calls:
+				errors = sum(1 for failed, _ in self.calls if failed)
+				slows = sum(1 for _, slow in self.calls if slow)
+				if errors >= self.error_rate * len(self.calls) or slows >= self.slow_rate * len(self.calls):
+					self._open()
+
+	def call(self, func, *args, **kwargs):
+		# failed(result) решает, считать ли ответ ошибкой (например, 5xx)
+		failed = kwargs.pop("failed", None)
+		if not self.allow():
+			raise BreakerOpen(self.name)
+		started = self.clock()
+		try:
+			result = func(*args, **kwargs)
+		except Exception:
+			self.record(True, self.clock() - started)
+			raise
+		self.record(bool(failed and failed(result)), self.clock() - started)
+		return result
+
+	def _open(self):
+		self.opened_at = self.clock()
+		self._switch(OPEN)
+
+	def _switch(self, state):
+		if state == self.state:
+			return
+		previous, self.state = self.state, state
+		logger.warning("Размыкатель %s: %s -> %s", self.name, previous, state)
+		if self.on_change is not None:
+			self.on_change(self.name, previous, state)
@@ -0,0 +1,115 @@
+import io
+import sys
+import json
+import struct
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+from reference_bundle import MAGIC, ALIGN, normalize_name, trigram_hashes
+
+# Какие справочники попадают в бандл и по какой колонке ищем название
+TABLES = {
+	"caloric_products.csv": "product_name",
+	"train_expenses.csv": "train_type",
+	"health_food.csv": "product_name",
+}
+
+
+class BlockWriter:
+	def __init__(self):
+		self.data = io.BytesIO()
+
+	def add(self, raw, count):
+		padding = -self.data.tell() % ALIGN
+		self.data.write(b"\0" * padding)
+		offset = self.data.tell()
+		self.data.write(raw)
+		return {"offset": offset, "count": count}
+
+	def add_array(self, array):
+		return self.add(array.tobytes(), len(array))
+
+	def add_strings(self, values):
+		encoded = [value.encode("utf-8") for value in values]
+		offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+		offsets[1:] = np.cumsum([len(value) for value in encoded])
+		blob = b"".join(encoded)
+		return {
+			"kind": "str",
+			"offsets": self.add_array(offsets),
+			"data": self.add(blob, len(blob)),
+		}
+
+
+def build_index(writer, names):
+	postings = {}
+	for row, name in enumerate(names):
+		for key in trigram_hashes(name):
+			postings.setdefault(key, []).append(row)
+	keys = np.array(sorted(postings), dtype=np.uint32)
+	offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum([len(postings[key]) for key in keys])
+	rows = np.array([row for key in keys for row in postings[key]], dtype=np.int32)
+	return {
+		"keys": writer.add_array(keys),
+		"offsets": writer.add_array(offsets),
+		"rows": writer.add_array(rows),
+	}
+
+
+def build(source_dir, output):
+	writer = BlockWriter()
+	tables = {}
+	digest = hashlib.sha256()
+
+	for file_name, name_column in TABLES.items():
+		with open(f"{source_dir}/{file_name}", "rb") as f:
+			raw = f.read()
+		digest.update(raw)
+		df = pd.read_csv(io.BytesIO(raw), encoding="utf-8-sig")
+
+		columns = {}
+		for column in df.columns:
+			if pd.api.types.is_numeric_dtype(df[column]):
+				dtype = np.int64 if pd.api.types.is_integer_dtype(df[column]) else np.float64
+				values = df[column].to_numpy(dtype=dtype)
+				columns[column] = {"kind": "num", "dtype": values.dtype.name, **writer.add_array(values)}
+			else:
+				columns[column] = writer.add_strings(df[column].astype(str).str.strip().tolist())
+
+		normalized = [normalize_name(name) for name in df[name_column]]
+		columns["_normalized"] = writer.add_strings(normalized)
+		tables[file_name] = {
+			"rows": len(df),
+			"name_column": name_column,
+			"columns": columns,
+			"index": build_index(writer, normalized),
+		}
+
+	header = json.dumps({"version": digest.hexdigest()[:12], "tables": tables}, ensure_ascii=False).encode("utf-8")
+	# Смещения в заголовке считаются от начала блока данных, который выровнен по ALIGN
+	start = len(MAGIC) + 4 + len(header)
+	data_start = start + (-start % ALIGN)
+
+	with open(output, "wb") as f:
+		f.write(MAGIC)
+		f.write(struct.pack("<I", len(header)))
+		f.write(header)
+		f.write(b"\0" * (data_start - start))
+		f.write(writer.data.getvalue())
+	return digest.hexdigest()[:12]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Собирает справочники в бинарный бандл для быстрого холодного старта")
+	parser.add_argument("--source", default=".", help="папка с CSV-справочниками")
+	parser.add_argument("--output", default="reference.bundle")
+	args = parser.parse_args(argv)
+	version = build(args.source, args.output)
+	print(f"{args.output}: версия {version}")
+
+
+if __name__ == "__main__":
+	sys.exit(main())
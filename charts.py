@@ -0,0 +1,41 @@
+import os
+os.environ.setdefault("MPLCONFIGDIR", "/tmp/matplotlib")
+import io
+import numpy as np
+from datetime import datetime, timezone
+from matplotlib.figure import Figure
+
+# Графики рисуются без pyplot: у каждого вызова своя Figure, поэтому рендер не трогает
+# глобальное состояние и его можно отдавать в потоки или в пул процессов
+MAX_TICKS = 24
+
+
+def render_chart(timestamps, cumulative, goal, title, xlabel, ylabel, unit, figsize=(10, 6), dpi=100):
+	# timestamps – время записей в секундах (datetime64[s] без часового пояса),
+	# cumulative – накопленные значения; на выходе PNG
+	cumulative = np.asarray(cumulative, dtype=float)
+	steps = np.arange(1, len(cumulative) + 1)
+
+	fig = Figure(figsize=figsize, dpi=dpi)
+	ax = fig.add_subplot()
+	ax.plot(steps, cumulative, marker="o", linewidth=2)
+	ax.axhline(goal, color='r', linestyle="--", label=f'Цель: {goal} {unit}')
+	ax.set_title(title)
+	if len(steps) <= MAX_TICKS:
+		ax.set_xticks(steps, [datetime.fromtimestamp(t, timezone.utc).strftime("%H:%M") for t in timestamps])
+	ax.set_xlabel(xlabel)
+	ax.set_ylabel(ylabel)
+	ax.legend()
+	ax.grid(True, alpha=0.3)
+	fig.tight_layout()
+
+	buf = io.BytesIO()
+	fig.savefig(buf, format="png")
+	return buf.getvalue()
+
+
+def chart_series(df, value_column):
+	# Из журнала за день – простые массивы, которые дёшево передать в другой процесс
+	timestamps = df["datetime"].to_numpy().astype("datetime64[s]").astype(np.int64)
+	cumulative = df[value_column].cumsum().to_numpy(dtype=float)
+	return timestamps, cumulative
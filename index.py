@@ -1,23 +1,70 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 import requests
 import telebot
 import os
-import io
+import json
+import hmac
+import profiling
+import metrics
+import charts
+import queue
+import signal
+import threading
+import multiprocessing
+import shared_state
 from difflib import get_close_matches
+from functools import wraps
+from math import ceil
+from throttle import Throttle
 from datetime import datetime, date, time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 from telebot import types
 
-TOKEN = "Telegram_token"
+TOKEN = os.environ.get("TELEGRAM_TOKEN", "Telegram_token")
 OPENWEATHER_TOKEN = "Openweather_token"
-bot = telebot.TeleBot(TOKEN)
+# Для локальной проверки можно направить бота на поддельный API: http://127.0.0.1:8081/bot{0}/{1}
+if os.environ.get("TELEGRAM_API_URL"):
+	telebot.apihelper.API_URL = os.environ["TELEGRAM_API_URL"]
+# BOT_MODE=webhook: вместо long polling HTTP-сервер с WEBHOOK_WORKERS процессами на одном порту
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # публичный адрес за прокси с TLS, его получит setWebhook
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token, запросы без него отклоняются
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
 
 CSV_FILE = "users.csv"
 FOOD_CSV = "caloric_products.csv"
 WATER_LOG_CSV = "water_log.csv"
 FOOD_LOG_CSV = "food_log.csv"
-users_state = {}  # временно храним данные при заполнении информации о пользователе
-food_state = {}  # временно храним информацию о блюде
+# Процессы вебхук-сервера не видят словари друг друга, поэтому состояние диалогов у них в файлах
+if BOT_MODE == "webhook":
+	users_state = shared_state.FileState("users")  # временно храним данные при заполнении информации о пользователе
+	food_state = shared_state.FileState("food")  # временно храним информацию о блюде
+	next_step_backend = shared_state.SharedHandlerBackend(shared_state.FileState("next_steps"))
+else:
+	users_state = shared_state.MemoryState()
+	food_state = shared_state.MemoryState()
+	next_step_backend = None
+# В вебхуке обновление обрабатывается прямо в запросе: Telegram получает ответ, когда всё записано
+bot = telebot.TeleBot(TOKEN, threaded=BOT_MODE != "webhook", next_step_backend=next_step_backend)
+# Лимиты частоты команд; в режиме вебхука корзины дорогих команд пользователя общие для всех процессов
+throttle = Throttle(shared=shared_state.FileState("throttle").change if BOT_MODE == "webhook" else None)
+# UPDATE_MODE=defer: поток опроса только кладёт обновления в очередь, обрабатывают их UPDATE_WORKERS потоков
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "")
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "2"))
+updates_queue = queue.Queue()
+# Графики рисуются в отдельных процессах, чтобы не держать GIL в потоках обработчиков
+CHART_WORKERS = int(os.environ.get("CHART_WORKERS", str(os.cpu_count() or 1)))
+# Пул создаётся при первом графике: процессы forkserver заново импортируют этот модуль
+chart_pool = None
+chart_pool_lock = threading.Lock()
+chart_slots = threading.BoundedSemaphore(CHART_WORKERS * 2)
+# Если задан порт, метрики Prometheus доступны по http://localhost:<порт>/metrics
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
 
 
 def load_users():
@@ -31,11 +78,44 @@ def load_users():
 			"last_reset_date"
 		])
 
+def write_users(df):
+	# Через временный файл: другой процесс не прочитает наполовину записанный CSV
+	df.to_csv(CSV_FILE + ".tmp", index=False)
+	os.replace(CSV_FILE + ".tmp", CSV_FILE)
+
 def save_user(data):
-	df = load_users()
-	df = df[df.user_id != data["user_id"]]
-	df = pd.concat([df, pd.DataFrame([data])], ignore_index=True)
-	df.to_csv(CSV_FILE, index=False)
+	with shared_state.file_lock(CSV_FILE):
+		df = load_users()
+		df = df[df.user_id != data["user_id"]]
+		df = pd.concat([df, pd.DataFrame([data])], ignore_index=True)
+		write_users(df)
+
+def add_to_user(user_id, column, amount):
+	with shared_state.file_lock(CSV_FILE):
+		df = load_users()
+		df.loc[df.user_id == user_id, column] += amount
+		write_users(df)
+
+
+def allow_command(chat_id, command_class):
+	wait = throttle.take(chat_id, command_class)
+	if not wait:
+		return True
+	metrics.inc("bot_throttled_total", command_class=command_class)
+	# На серию повторов – одно предупреждение
+	if throttle.first_refusal(chat_id, command_class, wait):
+		bot.send_message(chat_id, f"⏳ Слишком часто. Повторите через {ceil(wait)} с")
+	return False
+
+def throttled(command_class):
+	def decorator(func):
+		@wraps(func)
+		def wrapper(message, *args, **kwargs):
+			if not allow_command(message.chat.id, command_class):
+				return
+			return func(message, *args, **kwargs)
+		return wrapper
+	return decorator
 
 
 @bot.message_handler(commands=["start"])
@@ -83,24 +163,31 @@ def keyboard_buttons(message):
 
 
 def reset_daily_if_needed(user_id):
-	df = load_users()
+	# Сброс нужен раз в день, поэтому сначала проверяем без блокировки: CSV подменяется атомарно
 	today = date.today().isoformat()
-
+	df = load_users()
 	user = df[df.user_id == user_id]
-	if user.empty:
+	if user.empty or user.iloc[0]["last_reset_date"] == today:
 		return
 
-	last_reset = user.iloc[0]["last_reset_date"]
+	with shared_state.file_lock(CSV_FILE):
+		df = load_users()
 
-	if last_reset != today:
-		df.loc[df.user_id == user_id, [
-			"logged_water",
-			"logged_calories",
-			"burned_calories"
-		]] = 0
+		user = df[df.user_id == user_id]
+		if user.empty:
+			return
+
+		last_reset = user.iloc[0]["last_reset_date"]
+
+		if last_reset != today:
+			df.loc[df.user_id == user_id, [
+				"logged_water",
+				"logged_calories",
+				"burned_calories"
+			]] = 0
 
-		df.loc[df.user_id == user_id, "last_reset_date"] = today
-		df.to_csv(CSV_FILE, index=False)
+			df.loc[df.user_id == user_id, "last_reset_date"] = today
+			write_users(df)
 
 def calculate_bmr(gender, weight, height, age):
 	if gender == "m":
@@ -126,7 +213,7 @@ def water_norm(weight):
 
 @bot.message_handler(commands=["set_profile"])
 def set_profile(message):
-	users_state[message.chat.id] = {"user_id": message.chat.id}
+	shared_state.set_value(users_state, message.chat.id, {"user_id": message.chat.id})
 
 	markup = types.InlineKeyboardMarkup()
 	markup.add(
@@ -144,7 +231,7 @@ def set_profile(message):
 @bot.callback_query_handler(func=lambda call: call.data.startswith("gender_"))
 def callback_set_gender(call):
 	gender = call.data.split("_")[1]
-	users_state[call.message.chat.id]["gender"] = gender
+	shared_state.update_fields(users_state, call.message.chat.id, gender=gender)
 
 	bot.edit_message_reply_markup(
 		call.message.chat.id,
@@ -155,27 +242,27 @@ def callback_set_gender(call):
 	bot.register_next_step_handler(call.message, set_weight)
 
 def set_weight(message):
-	users_state[message.chat.id]["weight"] = float(message.text)
+	shared_state.update_fields(users_state, message.chat.id, weight=float(message.text))
 	bot.send_message(message.chat.id, "Введите ваш рост (см):")
 	bot.register_next_step_handler(message, set_height)
 
 def set_height(message):
-	users_state[message.chat.id]["height"] = int(message.text)
+	shared_state.update_fields(users_state, message.chat.id, height=int(message.text))
 	bot.send_message(message.chat.id, "Введите ваш возраст:")
 	bot.register_next_step_handler(message, set_age)
 
 def set_age(message):
-	users_state[message.chat.id]["age"] = int(message.text)
+	shared_state.update_fields(users_state, message.chat.id, age=int(message.text))
 	bot.send_message(message.chat.id, "Сколько минут активности у вас в день?")
 	bot.register_next_step_handler(message, set_activity)
 
 def set_activity(message):
-	users_state[message.chat.id]["activity"] = int(message.text)
+	shared_state.update_fields(users_state, message.chat.id, activity=int(message.text))
 	bot.send_message(message.chat.id, "В каком городе вы находитесь?")
 	bot.register_next_step_handler(message, set_city)
 
 def set_city(message):
-	users_state[message.chat.id]["city"] = message.text
+	shared_state.update_fields(users_state, message.chat.id, city=message.text)
 
 	markup = types.InlineKeyboardMarkup()
 	markup.add(
@@ -203,18 +290,18 @@ def callback_calories_mode(call):
 		calculate_auto_calories(call.message)
 
 def set_manual_calories(message):
-	users_state[message.chat.id]["calorie_goal"] = int(message.text)
+	shared_state.update_fields(users_state, message.chat.id, calorie_goal=int(message.text))
 	finalize_profile(message)
 
 def calculate_auto_calories(message):
-	user_local = users_state[message.chat.id]
+	user_local = users_state.get(message.chat.id)
 	bmr = calculate_bmr(user_local["gender"], user_local["weight"], user_local["height"], user_local["age"])
 	multiplier = activity_multiplier(user_local["activity"])
-	user_local["calorie_goal"] = int(bmr * multiplier)
+	shared_state.update_fields(users_state, message.chat.id, calorie_goal=int(bmr * multiplier))
 	finalize_profile(message)
 
 def finalize_profile(message):
-	user_local = users_state[message.chat.id]
+	user_local = users_state.pop(message.chat.id)
 
 	user_local["water_goal"] = water_norm(user_local["weight"])
 	user_local["logged_water"] = 0
@@ -241,19 +328,21 @@ def log_water(message):
 		bot.send_message(message.chat.id, "Использование: /log_water <мл>")
 		return
 
-	df = load_users()
-	user = df[df.user_id == message.chat.id]
+	with shared_state.file_lock(CSV_FILE):
+		df = load_users()
+		user = df[df.user_id == message.chat.id]
+
+		if not user.empty:
+			logged = int(user.iloc[0]["logged_water"]) + amount
+			goal = int(user.iloc[0]["water_goal"])
+
+			df.loc[df.user_id == message.chat.id, "logged_water"] = logged
+			write_users(df)
 
 	if user.empty:
 		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
 		return
 
-	logged = int(user.iloc[0]["logged_water"]) + amount
-	goal = int(user.iloc[0]["water_goal"])
-
-	df.loc[df.user_id == message.chat.id, "logged_water"] = logged
-	df.to_csv(CSV_FILE, index=False)
-
 	append_water_log(message.chat.id, amount)
 
 	remaining = max(goal - logged, 0)
@@ -265,12 +354,25 @@ def log_water(message):
 	)
 
 
+def upstream_get(upstream, url, **kwargs):
+	# Те же метрики внешних API, что и в облачной функции: время запроса и ошибки
+	try:
+		with metrics.timer("bot_upstream_seconds", upstream=upstream):
+			response = requests.get(url, **kwargs)
+	except Exception:
+		metrics.inc("bot_upstream_errors_total", upstream=upstream)
+		raise
+	if response.status_code >= 500 or response.status_code == 429:
+		metrics.inc("bot_upstream_errors_total", upstream=upstream)
+	return response
+
+
 def get_city_temperature(city):
 	url = (
 		"https://api.openweathermap.org/data/2.5/weather"
 		f"?q={city}&appid={OPENWEATHER_TOKEN}&units=metric&lang=ru"
 	)
-	response = requests.get(url)
+	response = upstream_get("openweather", url)
 	if response.status_code == 200:
 		data = response.json()
 		return data["main"]["temp"]
@@ -279,6 +381,7 @@ def get_city_temperature(city):
 		return None
 
 @bot.message_handler(commands=["log_workout"])
+@throttled("lookup")
 def log_workout(message):
 	reset_daily_if_needed(message.chat.id)
 	try:
@@ -334,8 +437,7 @@ def log_workout(message):
 
 	total_water = water_needed + extra_water
 
-	users_df.loc[users_df.user_id == message.chat.id, "burned_calories"] += calories_burned
-	users_df.to_csv(CSV_FILE, index=False)
+	add_to_user(message.chat.id, "burned_calories", calories_burned)
 
 	bot.send_message(
 		message.chat.id,
@@ -350,7 +452,7 @@ def get_food_info(product_name):
 		"https://world.openfoodfacts.org/cgi/search.pl"
 		f"?action=process&search_terms={product_name}&json=true&page_size=5"
 	)
-	response = requests.get(url, timeout=10)
+	response = upstream_get("openfoodfacts", url, timeout=10)
 
 	if response.status_code != 200:
 		return None
@@ -390,6 +492,7 @@ def get_food_from_csv(product_name):
 
 
 @bot.message_handler(commands=["log_food"])
+@throttled("lookup")
 def log_food(message):
 	reset_daily_if_needed(message.chat.id)
 	try:
@@ -412,7 +515,7 @@ def log_food(message):
 
 	# 3. Позиция найдена
 	if food:
-		food_state[message.chat.id] = food
+		shared_state.set_value(food_state, message.chat.id, food)
 
 		bot.send_message(
 			message.chat.id,
@@ -442,9 +545,7 @@ def ask_food_weight(message):
 	food = food_state.pop(message.chat.id)
 	calories = round(food["calories"] * grams / 100, 1)
 
-	df = load_users()
-	df.loc[df.user_id == message.chat.id, "logged_calories"] += calories
-	df.to_csv(CSV_FILE, index=False)
+	add_to_user(message.chat.id, "logged_calories", calories)
 
 	append_food_log(message.chat.id, calories)
 
@@ -461,9 +562,7 @@ def ask_manual_calories(message):
 		bot.register_next_step_handler(message, ask_manual_calories)
 		return
 
-	df = load_users()
-	df.loc[df.user_id == message.chat.id, "logged_calories"] += calories
-	df.to_csv(CSV_FILE, index=False)
+	add_to_user(message.chat.id, "logged_calories", calories)
 
 	append_food_log(message.chat.id, calories)
 
@@ -536,24 +635,31 @@ def profile(message):
 
 
 def reset_daily_if_needed(user_id):
-	df = load_users()
+	# Сброс нужен раз в день, поэтому сначала проверяем без блокировки: CSV подменяется атомарно
 	today = date.today().isoformat()
-
+	df = load_users()
 	user = df[df.user_id == user_id]
-	if user.empty:
+	if user.empty or user.iloc[0]["last_reset_date"] == today:
 		return
 
-	last_reset = user.iloc[0]["last_reset_date"]
+	with shared_state.file_lock(CSV_FILE):
+		df = load_users()
+
+		user = df[df.user_id == user_id]
+		if user.empty:
+			return
+
+		last_reset = user.iloc[0]["last_reset_date"]
 
-	if last_reset != today:
-		df.loc[df.user_id == user_id, [
-			"logged_water",
-			"logged_calories",
-			"burned_calories"
-		]] = 0
+		if last_reset != today:
+			df.loc[df.user_id == user_id, [
+				"logged_water",
+				"logged_calories",
+				"burned_calories"
+			]] = 0
 
-		df.loc[df.user_id == user_id, "last_reset_date"] = today
-		df.to_csv(CSV_FILE, index=False)
+			df.loc[df.user_id == user_id, "last_reset_date"] = today
+			write_users(df)
 
 
 def append_water_log(user_id, amount):
@@ -564,10 +670,11 @@ def append_water_log(user_id, amount):
 	}
 
 	df = pd.DataFrame([row])
-	if os.path.exists(WATER_LOG_CSV):
-		df.to_csv(WATER_LOG_CSV, mode="a", header=False, index=False)
-	else:
-		df.to_csv(WATER_LOG_CSV, index=False)
+	with shared_state.file_lock(WATER_LOG_CSV):
+		if os.path.exists(WATER_LOG_CSV):
+			df.to_csv(WATER_LOG_CSV, mode="a", header=False, index=False)
+		else:
+			df.to_csv(WATER_LOG_CSV, index=False)
 
 def append_food_log(user_id, calories):
 	row = {
@@ -577,20 +684,59 @@ def append_food_log(user_id, calories):
 	}
 
 	df = pd.DataFrame([row])
-	if os.path.exists(FOOD_LOG_CSV):
-		df.to_csv(FOOD_LOG_CSV, mode="a", header=False, index=False)
-	else:
-		df.to_csv(FOOD_LOG_CSV, index=False)
-
-
-def send_plot_as_photo(chat_id):
-	buf = io.BytesIO()
-	plt.savefig(buf, format="png")
-	buf.seek(0)
-	plt.close()
-	bot.send_photo(chat_id, buf)
+	with shared_state.file_lock(FOOD_LOG_CSV):
+		if os.path.exists(FOOD_LOG_CSV):
+			df.to_csv(FOOD_LOG_CSV, mode="a", header=False, index=False)
+		else:
+			df.to_csv(FOOD_LOG_CSV, index=False)
+
+
+def new_chart_pool():
+	# fork при работающих потоках может унаследовать чужую захваченную блокировку и зависнуть,
+	# поэтому процессы для графиков порождает forkserver с заранее загруженным charts
+	context = multiprocessing.get_context("forkserver")
+	context.set_forkserver_preload(["charts"])
+	return ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=context)
+
+def current_chart_pool(broken=None):
+	global chart_pool
+	with chart_pool_lock:
+		# Если процесс пула убили (например, по памяти), пул больше не принимает задач – заменяем его
+		if chart_pool is None or chart_pool is broken:
+			if chart_pool is not None:
+				chart_pool.shutdown(wait=False)
+			chart_pool = new_chart_pool()
+		return chart_pool
+
+def submit_chart(*chart_args):
+	# Не больше двух задач на процесс в очереди, иначе обработчики ждут свободного места
+	chart_slots.acquire()
+	try:
+		pool = current_chart_pool()
+		try:
+			future = pool.submit(charts.render_chart, *chart_args)
+		except BrokenProcessPool:
+			future = current_chart_pool(broken=pool).submit(charts.render_chart, *chart_args)
+	except Exception as e:
+		# Место в очереди освобождаем сразу, ошибку покажет send_plot_as_photo
+		chart_slots.release()
+		future = Future()
+		future.set_exception(e)
+		return future
+	future.add_done_callback(lambda _: chart_slots.release())
+	return future
+
+def send_plot_as_photo(chat_id, chart):
+	try:
+		photo = chart.result()
+	except Exception as e:
+		print(f"Ошибка построения графика: {e}")
+		bot.send_message(chat_id, "Не удалось построить график, попробуйте позже")
+		return
+	bot.send_photo(chat_id, photo)
 
 @bot.message_handler(commands=["stats"])
+@throttled("render")
 def stats(message):
 	user_id = message.chat.id
 	today_start = datetime.combine(date.today(), time.min)
@@ -605,6 +751,8 @@ def stats(message):
 	water_goal = float(user.iloc[0]["water_goal"])
 	calorie_goal = float(user.iloc[0]["calorie_goal"])
 
+	water_chart = food_chart = None
+
 	# График по воде
 	if os.path.exists(WATER_LOG_CSV):
 		water_df = pd.read_csv(WATER_LOG_CSV)
@@ -616,24 +764,11 @@ def stats(message):
 		]
 
 		if not water_df.empty:
-			water_df["step"] = range(1, len(water_df) + 1)
-			water_df["cumulative"] = water_df.amount_ml.cumsum()
-
-			plt.figure()
-			plt.plot(
-				water_df["step"],
-				water_df["cumulative"],
-				marker="o",
-				linewidth=2
+			timestamps, cumulative = charts.chart_series(water_df, "amount_ml")
+			water_chart = submit_chart(
+				timestamps, cumulative, water_goal,
+				"Прогресс выпитой воды за день", "Приёмы воды", "мл", "мл"
 			)
-			plt.axhline(water_goal, linestyle="--")
-			plt.title("Прогресс выпитой воды за день")
-			plt.xticks(water_df["step"])
-			plt.xlabel("Приёмы воды")
-			plt.ylabel("мл")
-			plt.tight_layout()
-
-			send_plot_as_photo(message.chat.id)
 
 	# График по калориям
 	if os.path.exists(FOOD_LOG_CSV):
@@ -646,24 +781,16 @@ def stats(message):
 		]
 
 		if not food_df.empty:
-			food_df["step"] = range(1, len(food_df) + 1)
-			food_df["cumulative"] = food_df.calories.cumsum()
-
-			plt.figure()
-			plt.plot(
-				food_df["step"],
-				food_df["cumulative"],
-				marker="o",
-				linewidth=2
+			timestamps, cumulative = charts.chart_series(food_df, "calories")
+			food_chart = submit_chart(
+				timestamps, cumulative, calorie_goal,
+				"Прогресс по калориям за день", "Приёмы еды", "ккал", "ккал"
 			)
-			plt.axhline(calorie_goal, linestyle="--")
-			plt.title("Прогресс по калориям за день")
-			plt.xticks(food_df["step"])
-			plt.xlabel("Приёмы еды")
-			plt.ylabel("ккал")
-			plt.tight_layout()
 
-			send_plot_as_photo(message.chat.id)
+	# Оба графика рисуются параллельно, отправляем в прежнем порядке
+	for chart in (water_chart, food_chart):
+		if chart is not None:
+			send_plot_as_photo(message.chat.id, chart)
 
 
 @bot.message_handler(commands=["tip"])
@@ -729,7 +856,153 @@ def tip(message):
 	)
 
 
+def enqueue_updates(updates):
+	received_at = datetime.now().timestamp()
+	updates_queue.put((updates, received_at))
+	elapsed = datetime.now().timestamp() - received_at
+	metrics.observe("bot_webhook_seconds", elapsed, stage="ack")
+	print(f"Подтверждение: {elapsed * 1000:.1f} мс, в очереди {updates_queue.qsize()}")
+
+def process_queued_updates(process):
+	while True:
+		updates, received_at = updates_queue.get()
+		try:
+			process(updates)
+		except Exception as e:
+			print(f"Ошибка обработки обновлений: {e}")
+		elapsed = datetime.now().timestamp() - received_at
+		metrics.observe("bot_webhook_seconds", elapsed, stage="end_to_end")
+		print(f"Полная обработка: {elapsed * 1000:.0f} мс")
+
+def wrap_handlers(wrapper):
+	# При threaded=True process_new_updates только раздаёт задачи пулу потоков telebot и сразу
+	# возвращается, поэтому оборачиваем саму задачу обработчика: она выполняется в потоке пула
+	exec_task = bot._exec_task
+	def exec_wrapped(task, *args, **kwargs):
+		return exec_task(wrapper(task), *args, **kwargs)
+	bot._exec_task = exec_wrapped
+
+def limit_updates(process):
+	# Общий лимит cheap на все сообщения; дорогие команды дополнительно проверяет @throttled
+	def wrapper(updates):
+		allowed = [
+			update for update in updates
+			if update.message is None or allow_command(update.message.chat.id, "cheap")
+		]
+		if allowed:
+			return process(allowed)
+	return wrapper
+
+def counted(process):
+	def wrapper(updates):
+		for update in updates:
+			text = update.message.text if update.message and update.message.text else ""
+			command = text.split()[0].split("@")[0] if text.startswith("/") else "text"
+			metrics.inc("bot_updates_total", command=command)
+		return process(updates)
+	return wrapper
+
+def timed(task):
+	def wrapper(*args, **kwargs):
+		with metrics.timer("bot_update_seconds"):
+			return task(*args, **kwargs)
+	return wrapper
+
+def webhook_app(environ, start_response):
+	# Тот же набор обработчиков, что и при опросе: обновление из тела запроса уходит в process_new_updates
+	if environ["REQUEST_METHOD"] != "POST":
+		start_response("405 Method Not Allowed", [("Content-Type", "text/plain")])
+		return [b"method not allowed"]
+	if WEBHOOK_SECRET and not hmac.compare_digest(environ.get("HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN", ""), WEBHOOK_SECRET):
+		start_response("403 Forbidden", [("Content-Type", "text/plain")])
+		return [b"forbidden"]
+	body = environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0))
+	# Неразборчивое тело не обработается и при повторе, поэтому отвечаем 400, а не 500
+	try:
+		update_dict = json.loads(body.decode("utf-8"))
+		if not isinstance(update_dict, dict) or "update_id" not in update_dict:
+			raise ValueError("not an update")
+		update = types.Update.de_json(update_dict)
+	except Exception as e:
+		print(f"Некорректное обновление: {e}")
+		start_response("400 Bad Request", [("Content-Type", "text/plain")])
+		return [b"bad update"]
+	try:
+		bot.process_new_updates([update])
+	except Exception as e:
+		print(f"Ошибка обработки обновления: {e}")
+	start_response("200 OK", [("Content-Type", "text/plain")])
+	return [b"ok"]
+
+class WebhookServer(WSGIServer):
+	# Telegram открывает до 40 соединений сразу (max_connections), очередь в 5 мест мала
+	request_queue_size = 128
+
+class QuietHandler(WSGIRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+def run_webhook_worker(server):
+	global chart_pool
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+	# Пул для графиков у каждого процесса свой, он создастся при первом графике
+	chart_pool = None
+	server.serve_forever()
+
+def serve_webhook():
+	# Сокет открывает родитель, рабочие процессы наследуют его и принимают соединения сами
+	server = make_server(WEBHOOK_HOST, WEBHOOK_PORT, webhook_app, server_class=WebhookServer, handler_class=QuietHandler)
+	if WEBHOOK_URL:
+		bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+	if not WEBHOOK_SECRET:
+		print("WEBHOOK_SECRET не задан: вебхук примет обновление от любого, кто знает адрес")
+	workers = set()
+
+	def stop(signum, frame):
+		for pid in workers:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+		os._exit(0)
+
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	print(f"Вебхук на {WEBHOOK_HOST}:{WEBHOOK_PORT}, процессов: {WEBHOOK_WORKERS}")
+	while True:
+		while len(workers) < WEBHOOK_WORKERS:
+			pid = os.fork()
+			if pid == 0:
+				run_webhook_worker(server)
+				os._exit(0)
+			workers.add(pid)
+		# Упавший процесс сразу заменяем новым
+		pid, status = os.wait()
+		workers.discard(pid)
+		print(f"Процесс {pid} завершился ({status}), запускаем новый")
+
 def main():
+	# Профилирование включается переменными PROFILE_MODE / PROFILE_SAMPLE_RATE / PROFILE_SLOW_MS
+	if profiling.settings["mode"]:
+		wrap_handlers(lambda task: profiling.wrap("update", task))
+	bot.process_new_updates = limit_updates(bot.process_new_updates)
+	if BOT_MODE == "webhook":
+		serve_webhook()
+		return
+	if METRICS_PORT:
+		metrics.inc("bot_cold_starts_total")
+		metrics.serve(METRICS_PORT)
+		bot.process_new_updates = counted(bot.process_new_updates)
+		# Время меряем там, где выполняется обработчик, а не раздача задач пулу
+		wrap_handlers(timed)
+	if UPDATE_MODE == "defer":
+		# Обработчики выполняются прямо в потоках очереди, иначе end_to_end закончился бы
+		# на раздаче задач пулу telebot, а не после обработки
+		bot.threaded = False
+		for _ in range(UPDATE_WORKERS):
+			threading.Thread(target=process_queued_updates, args=(bot.process_new_updates,), daemon=True).start()
+		bot.process_new_updates = enqueue_updates
 	bot.infinity_polling()
 
 if __name__ == "__main__":
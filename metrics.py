@@ -0,0 +1,171 @@
+import time
+import weakref
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Метрики в текстовом формате Prometheus. Каждый поток пишет в свой набор счётчиков без блокировок,
+# а render() складывает наборы всех потоков только при чтении /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+descriptions = {
+	"bot_cold_starts_total": ("counter", "Запуски инстанса"),
+	"bot_updates_total": ("counter", "Обработанные команды"),
+	"bot_updates_duplicate_total": ("counter", "Отброшенные повторные доставки обновлений"),
+	"bot_update_seconds": ("histogram", "Время обработки обновления"),
+	"bot_webhook_seconds": ("histogram", "Время до ответа вебхука (ack) и полной обработки (end_to_end)"),
+	"bot_s3_operations_total": ("counter", "Запросы к Object Storage"),
+	"bot_s3_bytes_total": ("counter", "Байты, прочитанные и записанные в Object Storage"),
+	"bot_upstream_seconds": ("histogram", "Время запросов к внешним API"),
+	"bot_upstream_errors_total": ("counter", "Ошибки внешних API"),
+	"bot_cache_requests_total": ("counter", "Обращения к кэшам"),
+	"bot_breaker_state": ("gauge", "Состояние размыкателя: 0 – замкнут, 1 – полуоткрыт, 2 – разомкнут"),
+	"bot_breaker_transitions_total": ("counter", "Переключения размыкателей"),
+	"bot_breaker_rejected_total": ("counter", "Вызовы, сразу отправленные в запасной вариант"),
+	"bot_throttled_total": ("counter", "Команды, отклонённые лимитом частоты"),
+}
+
+# Значения gauge просто перезаписываются, присваивание в словарь атомарно
+gauges = {}
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+# Счётчики завершившихся потоков: пулы создаются на каждый вызов, и без слияния наборы копились бы
+_retired = ({}, {})
+
+
+class _Owner:
+	# Живёт в threading.local и удаляется вместе с потоком – по нему узнаём, что поток завершился
+	pass
+
+
+def _shard():
+	shard = getattr(_local, "shard", None)
+	if shard is None:
+		shard = ({}, {})
+		_local.owner = _Owner()
+		weakref.finalize(_local.owner, _retire, shard)
+		# Блокировка нужна только один раз, когда поток впервые пишет метрику
+		with _shards_lock:
+			_shards.append(shard)
+		_local.shard = shard
+	return shard
+
+
+def _retire(shard):
+	with _shards_lock:
+		_merge(_retired, shard)
+		_shards.remove(shard)
+
+
+def _merge(target, shard):
+	counters, histograms = target
+	shard_counters, shard_histograms = shard
+	for key, value in list(shard_counters.items()):
+		counters[key] = counters.get(key, 0) + value
+	for key, (buckets, counts, total) in list(shard_histograms.items()):
+		merged = histograms.setdefault(key, [buckets, [0] * len(counts), 0.0])
+		merged[1] = [a + b for a, b in zip(merged[1], counts)]
+		merged[2] += total
+
+
+def _key(name, labels):
+	return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+	counters = _shard()[0]
+	key = _key(name, labels)
+	counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+	histograms = _shard()[1]
+	key = _key(name, labels)
+	histogram = histograms.get(key)
+	if histogram is None:
+		histogram = histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+	histogram[1][bisect_left(buckets, value)] += 1
+	histogram[2] += value
+
+
+def set_gauge(name, value, **labels):
+	gauges[_key(name, labels)] = value
+
+
+@contextmanager
+def timer(name, **labels):
+	started = time.perf_counter()
+	try:
+		yield
+	finally:
+		observe(name, time.perf_counter() - started, **labels)
+
+
+def _format_labels(labels, extra=()):
+	pairs = list(labels) + list(extra)
+	if not pairs:
+		return ""
+	return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def _format_value(value):
+	return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def collect():
+	result = ({}, {})
+	# Под блокировкой, чтобы набор потока не попал в сумму дважды, если поток завершается прямо сейчас
+	with _shards_lock:
+		_merge(result, _retired)
+		for shard in _shards:
+			_merge(result, shard)
+	return result
+
+
+def render():
+	counters, histograms = collect()
+	counters.update(gauges)
+	counter_names = {name for name, _ in counters}
+	lines = []
+	for name in sorted(counter_names | {name for name, _ in histograms}):
+		kind, help_text = descriptions.get(name, ("counter" if name in counter_names else "histogram", name))
+		lines.append(f"# HELP {name} {help_text}")
+		lines.append(f"# TYPE {name} {kind}")
+		for (metric, labels), value in sorted(counters.items()):
+			if metric == name:
+				lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+		for (metric, labels), (buckets, counts, total) in sorted(histograms.items()):
+			if metric != name:
+				continue
+			cumulative = 0
+			for bound, count in zip(list(buckets) + ["+Inf"], counts):
+				cumulative += count
+				lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+			lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+			lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+	return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split("?")[0] != "/metrics":
+			self.send_error(404)
+			return
+		body = render().encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+def serve(port, host="0.0.0.0"):
+	# Небольшой HTTP-сервер для локального бота: GET /metrics в отдельном потоке
+	server = ThreadingHTTPServer((host, port), MetricsHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
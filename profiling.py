@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import random
+import cProfile
+import marshal
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger("bot")
+
+# PROFILE_MODE: "" (выключено), "cprofile" (pstats-файлы) или "sample" (collapsed stacks для flame graph)
+settings = {
+	"mode": os.environ.get("PROFILE_MODE", ""),
+	"sample_rate": float(os.environ.get("PROFILE_SAMPLE_RATE", "1.0")),
+	"slow_ms": float(os.environ.get("PROFILE_SLOW_MS", "0")),
+	"interval_ms": float(os.environ.get("PROFILE_INTERVAL_MS", "5")),
+	"dir": os.environ.get("PROFILE_DIR", "/tmp/profiles"),
+}
+
+# Куда сохраняем результат: по умолчанию локальная папка, бот может подменить на S3
+sink = None
+
+
+def configure(mode=None, sample_rate=None, slow_ms=None):
+	if mode is not None:
+		if mode not in ("", "cprofile", "sample"):
+			raise ValueError(f"Unknown profile mode: {mode}")
+		settings["mode"] = mode
+	if sample_rate is not None:
+		settings["sample_rate"] = max(0.0, min(float(sample_rate), 1.0))
+	if slow_ms is not None:
+		settings["slow_ms"] = max(0.0, float(slow_ms))
+
+
+def describe():
+	if not settings["mode"]:
+		return "выключено"
+	return (
+		f"режим={settings['mode']}, "
+		f"доля={settings['sample_rate']}, "
+		f"порог={settings['slow_ms']:.0f} мс"
+	)
+
+
+def save_profile(file_name, data):
+	if sink is not None:
+		sink(file_name, data)
+		return
+	os.makedirs(settings["dir"], exist_ok=True)
+	with open(os.path.join(settings["dir"], file_name), "wb") as f:
+		f.write(data)
+
+
+def run_profiled(label, func, *args, **kwargs):
+	mode = settings["mode"]
+	if not mode or random.random() >= settings["sample_rate"]:
+		return func(*args, **kwargs)
+
+	if mode == "sample":
+		sampler = StackSampler(threading.get_ident(), settings["interval_ms"] / 1000)
+		sampler.start()
+	else:
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+	started = time.perf_counter()
+	try:
+		return func(*args, **kwargs)
+	finally:
+		elapsed_ms = (time.perf_counter() - started) * 1000
+		if mode == "sample":
+			sampler.stop()
+		else:
+			profiler.disable()
+
+		# Сохраняем только медленные обновления, если задан порог
+		if elapsed_ms >= settings["slow_ms"]:
+			try:
+				stamp = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+				if mode == "sample":
+					data = sampler.collapsed().encode("utf-8")
+					file_name = f"{label}-{stamp}-{elapsed_ms:.0f}ms.collapsed"
+				else:
+					data = dump_pstats(profiler)
+					file_name = f"{label}-{stamp}-{elapsed_ms:.0f}ms.prof"
+				save_profile(file_name, data)
+				logger.info("Профиль %s сохранён (%.0f мс)", file_name, elapsed_ms)
+			except Exception as e:
+				logger.error(f"Profile save error: {e}")
+
+
+def wrap(label, func):
+	def wrapper(*args, **kwargs):
+		return run_profiled(label, func, *args, **kwargs)
+	return wrapper
+
+
+def dump_pstats(profiler):
+	# Тот же формат, что пишет pstats.Stats.dump_stats, но без временного файла
+	profiler.create_stats()
+	return marshal.dumps(profiler.stats)
+
+
+class StackSampler:
+	def __init__(self, thread_id, interval):
+		self.thread_id = thread_id
+		self.interval = interval
+		self.stacks = Counter()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			if frame is None:
+				continue
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+				frame = frame.f_back
+			self.stacks[";".join(reversed(stack))] += 1
+
+	def collapsed(self):
+		return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
@@ -0,0 +1,38 @@
+import time
+
+# Token bucket хранится компактно: key -> [токены, время последнего обновления]
+
+
+def _refill(buckets, key, rate, burst, now):
+	bucket = buckets.get(key)
+	if bucket is None:
+		bucket = buckets[key] = [float(burst), now]
+	else:
+		bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+		bucket[1] = now
+	return bucket
+
+
+def bucket_wait(buckets, key, rate, burst, now=None, cost=1):
+	# Сколько секунд подождать, пока в корзине наберётся cost токенов (0 – можно сразу)
+	now = time.monotonic() if now is None else now
+	bucket = _refill(buckets, key, rate, burst, now)
+	if bucket[0] >= cost:
+		return 0.0
+	return (cost - bucket[0]) / rate
+
+
+def bucket_take(buckets, key, rate, burst, now=None, cost=1):
+	now = time.monotonic() if now is None else now
+	wait = bucket_wait(buckets, key, rate, burst, now, cost)
+	if wait == 0:
+		buckets[key][0] -= cost
+	return wait
+
+
+def bucket_prune(buckets, rate, burst, now=None):
+	# Полностью восстановившиеся корзины ничем не отличаются от новых, их можно забыть
+	now = time.monotonic() if now is None else now
+	full_after = burst / rate
+	for key in [key for key, (_, updated) in buckets.items() if now - updated >= full_after]:
+		del buckets[key]
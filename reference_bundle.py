@@ -0,0 +1,108 @@
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+from difflib import get_close_matches
+
+# Формат файла: MAGIC, длина заголовка (uint32), JSON-заголовок, затем блок данных, выровненный по 8 байт.
+# Смещения в заголовке считаются от начала блока данных
+MAGIC = b"TBREF001"
+ALIGN = 8
+FUZZY_CANDIDATES = 20
+
+
+def normalize_name(name):
+	return " ".join(str(name).strip().lower().split())
+
+
+def trigram_hashes(text):
+	padded = f"  {text} "
+	return sorted({zlib.crc32(padded[i:i + 3].encode("utf-8")) for i in range(len(padded) - 2)})
+
+
+class BundleTable:
+	def __init__(self, bundle, name, meta):
+		self.bundle = bundle
+		self.name = name
+		self.meta = meta
+		self.rows = meta["rows"]
+		self.name_column = meta["name_column"]
+		self._strings = {}
+
+	def _array(self, block, dtype):
+		return np.frombuffer(self.bundle.buffer, dtype=dtype, count=block["count"], offset=self.bundle.base + block["offset"])
+
+	def column(self, name):
+		block = self.meta["columns"][name]
+		if block["kind"] == "num":
+			# Числа не копируются: массив смотрит прямо в отображённый файл
+			return self._array(block, np.dtype(block["dtype"]))
+		if name not in self._strings:
+			offsets = self._array(block["offsets"], np.int64)
+			start = self.bundle.base + block["data"]["offset"]
+			data = self.bundle.buffer[start:start + block["data"]["count"]]
+			self._strings[name] = [
+				bytes(data[offsets[i]:offsets[i + 1]]).decode("utf-8") for i in range(self.rows)
+			]
+		return self._strings[name]
+
+	def normalized_names(self):
+		return self.column("_normalized")
+
+	def match(self, query, cutoff=0.6):
+		# Триграммный индекс сужает поиск до нескольких кандидатов, difflib выбирает лучший
+		names = self.normalized_names()
+		query = normalize_name(query)
+		keys = self._array(self.meta["index"]["keys"], np.uint32)
+		offsets = self._array(self.meta["index"]["offsets"], np.int64)
+		postings = self._array(self.meta["index"]["rows"], np.int32)
+
+		query_keys = np.array(trigram_hashes(query), dtype=np.uint32)
+		positions = np.searchsorted(keys, query_keys)
+		found = positions < len(keys)
+		positions = positions[found]
+		positions = positions[keys[positions] == query_keys[found]]
+		if not len(positions):
+			return None
+
+		hits = np.concatenate([postings[offsets[p]:offsets[p + 1]] for p in positions])
+		counts = np.bincount(hits, minlength=self.rows)
+		top = np.argsort(-counts, kind="stable")[:FUZZY_CANDIDATES]
+		candidates = {names[i]: int(i) for i in top if counts[i]}
+
+		matches = get_close_matches(query, list(candidates), n=1, cutoff=cutoff)
+		if not matches:
+			return None
+		return candidates[matches[0]]
+
+	def to_records(self):
+		columns = [column for column in self.meta["columns"] if not column.startswith("_")]
+		values = {column: self.column(column) for column in columns}
+		return [{column: values[column][i] for column in columns} for i in range(self.rows)]
+
+
+class ReferenceBundle:
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, "rb")
+		self.buffer = memoryview(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+		if bytes(self.buffer[:len(MAGIC)]) != MAGIC:
+			raise ValueError(f"{path} is not a reference bundle")
+		(header_length,) = struct.unpack_from("<I", self.buffer, len(MAGIC))
+		start = len(MAGIC) + 4
+		self.header = json.loads(bytes(self.buffer[start:start + header_length]).decode("utf-8"))
+		end = start + header_length
+		self.base = end + (-end % ALIGN)
+		self.version = self.header["version"]
+		self.tables = {name: BundleTable(self, name, meta) for name, meta in self.header["tables"].items()}
+
+	def table(self, name):
+		return self.tables.get(name)
+
+
+def open_bundle(path):
+	try:
+		return ReferenceBundle(path)
+	except FileNotFoundError:
+		return None
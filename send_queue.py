@@ -0,0 +1,144 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from ratelimit import bucket_wait, bucket_prune
+
+logger = logging.getLogger("bot")
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и около 1 в секунду в один чат
+GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))
+CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", "1"))
+CHAT_BURST = float(os.environ.get("SEND_CHAT_BURST", "3"))
+MAX_RETRIES = 3
+
+
+def get_retry_after(error):
+	result = getattr(error, "result_json", None) or {}
+	retry_after = (result.get("parameters") or {}).get("retry_after")
+	if retry_after is None and getattr(error, "error_code", None) != 429:
+		return None
+	return float(retry_after or 1)
+
+
+class SendQueue:
+	def __init__(self, api, workers=4, max_size=10000, global_rate=GLOBAL_RATE,
+			chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, clock=time.monotonic, sleep=time.sleep):
+		self.api = api
+		self.global_rate = global_rate
+		self.chat_rate = chat_rate
+		self.chat_burst = chat_burst
+		self.clock = clock
+		self.sleep = sleep
+		# Один чат всегда попадает в одну очередь, поэтому порядок сообщений в чате сохраняется
+		self.queues = [queue.Queue(max_size) for _ in range(workers)]
+		self.threads = []
+		self.buckets = {}
+		self.paused_until = 0.0
+		self.lock = threading.Lock()
+		self.idle = threading.Condition()
+		self.pending = 0
+		self.sent = 0
+		self.failed = 0
+		self.retried = 0
+		self.sent_times = deque(maxlen=1000)
+
+	def send(self, method, chat_id, *args, **kwargs):
+		future = Future()
+		self._start()
+		with self.idle:
+			self.pending += 1
+		self.queues[hash(chat_id) % len(self.queues)].put((method, chat_id, args, kwargs, future))
+		return future
+
+	def send_message(self, chat_id, text, **kwargs):
+		return self.send("send_message", chat_id, text, **kwargs)
+
+	def send_photo(self, chat_id, photo, **kwargs):
+		return self.send("send_photo", chat_id, photo, **kwargs)
+
+	def drain(self, timeout=None):
+		# Облачная функция замораживается после ответа, поэтому дожидаемся отправки всего
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self.idle:
+			while self.pending:
+				left = None if deadline is None else deadline - time.monotonic()
+				if left is not None and left <= 0:
+					return False
+				self.idle.wait(left)
+		return True
+
+	def stats(self):
+		now = self.clock()
+		recent = [t for t in self.sent_times if now - t <= 60]
+		return {
+			"depth": sum(q.qsize() for q in self.queues),
+			"pending": self.pending,
+			"sent": self.sent,
+			"failed": self.failed,
+			"retried": self.retried,
+			"rate_per_sec": round(len(recent) / 60, 2),
+		}
+
+	def _start(self):
+		if self.threads:
+			return
+		with self.lock:
+			if self.threads:
+				return
+			for q in self.queues:
+				thread = threading.Thread(target=self._worker, args=(q,), daemon=True)
+				thread.start()
+				self.threads.append(thread)
+
+	def _acquire(self, chat_id):
+		while True:
+			with self.lock:
+				now = self.clock()
+				wait = max(
+					self.paused_until - now,
+					bucket_wait(self.buckets, None, self.global_rate, self.global_rate, now),
+					bucket_wait(self.buckets, chat_id, self.chat_rate, self.chat_burst, now),
+				)
+				if wait <= 0:
+					self.buckets[None][0] -= 1
+					self.buckets[chat_id][0] -= 1
+					if len(self.buckets) > 10000:
+						bucket_prune(self.buckets, self.chat_rate, self.chat_burst, now)
+					return
+			self.sleep(wait)
+
+	def _worker(self, q):
+		while True:
+			method, chat_id, args, kwargs, future = q.get()
+			try:
+				future.set_result(self._deliver(method, chat_id, args, kwargs))
+				self.sent += 1
+				self.sent_times.append(self.clock())
+			except Exception as e:
+				self.failed += 1
+				# id чата в лог не пишем, только метод и ошибку
+				logger.error(f"Send error in {method}: {type(e).__name__}: {e}")
+				future.set_exception(e)
+			finally:
+				with self.idle:
+					self.pending -= 1
+					self.idle.notify_all()
+
+	def _deliver(self, method, chat_id, args, kwargs):
+		for attempt in range(MAX_RETRIES + 1):
+			self._acquire(chat_id)
+			try:
+				return getattr(self.api, method)(chat_id, *args, **kwargs)
+			except Exception as e:
+				retry_after = get_retry_after(e)
+				if retry_after is None or attempt == MAX_RETRIES:
+					raise
+				self.retried += 1
+				# 429 означает, что Telegram ограничил весь бот, а не только этот чат
+				with self.lock:
+					self.paused_until = max(self.paused_until, self.clock() + retry_after)
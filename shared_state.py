@@ -0,0 +1,107 @@
+import os
+import fcntl
+import pickle
+import threading
+from contextlib import contextmanager
+from telebot.handler_backends import HandlerBackend
+
+# Состояние диалогов для index.py. В режиме вебхука обновления одного чата могут попасть
+# в разные процессы, поэтому состояние лежит в файлах, а чтение-изменение-запись идёт под flock
+STATE_DIR = os.environ.get("STATE_DIR", ".bot-state")
+
+
+@contextmanager
+def file_lock(path):
+	# flock держится на открытом файле: работает и между процессами, и между потоками
+	with open(path + ".lock", "a") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class MemoryState:
+	# Для одного процесса (long polling) хватает словаря
+	def __init__(self):
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def get(self, key, default=None):
+		return self.values.get(key, default)
+
+	def change(self, key, func):
+		with self.lock:
+			value = self.values[key] = func(self.values.get(key))
+			return value
+
+	def pop(self, key, default=None):
+		with self.lock:
+			return self.values.pop(key, default)
+
+
+class FileState:
+	def __init__(self, name, directory=STATE_DIR):
+		self.directory = os.path.join(directory, name)
+		os.makedirs(self.directory, exist_ok=True)
+
+	def _path(self, key):
+		return os.path.join(self.directory, f"{key}.pickle")
+
+	def _read(self, key, default=None):
+		try:
+			with open(self._path(key), "rb") as f:
+				return pickle.load(f)
+		except FileNotFoundError:
+			return default
+
+	def get(self, key, default=None):
+		# Запись идёт через переименование, поэтому читать можно без блокировки
+		return self._read(key, default)
+
+	def change(self, key, func):
+		# Блокировка своя у каждого ключа: разные чаты не ждут друг друга
+		path = self._path(key)
+		with file_lock(path):
+			value = func(self._read(key))
+			with open(path + ".tmp", "wb") as f:
+				pickle.dump(value, f)
+			os.replace(path + ".tmp", path)
+			return value
+
+	def pop(self, key, default=None):
+		# get_handlers вызывается на каждое сообщение, а шаг диалога ждёт редко
+		if not os.path.exists(self._path(key)):
+			return default
+		with file_lock(self._path(key)):
+			value = self._read(key, default)
+			try:
+				os.remove(self._path(key))
+			except FileNotFoundError:
+				pass
+			return value
+
+
+def set_value(state, key, value):
+	return state.change(key, lambda _: value)
+
+
+def update_fields(state, key, **fields):
+	return state.change(key, lambda value: {**(value or {}), **fields})
+
+
+class SharedHandlerBackend(HandlerBackend):
+	# next_step_backend для telebot: шаг, зарегистрированный в одном процессе,
+	# срабатывает на следующем сообщении, даже если его получил другой процесс
+	def __init__(self, state):
+		super().__init__()
+		self.state = state
+
+	def register_handler(self, handler_group_id, handler):
+		self.state.change(handler_group_id, lambda handlers: (handlers or []) + [handler])
+
+	def clear_handlers(self, handler_group_id):
+		self.state.pop(handler_group_id)
+
+	def get_handlers(self, handler_group_id):
+		return self.state.pop(handler_group_id)
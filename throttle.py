@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+from ratelimit import bucket_wait, bucket_take, bucket_prune
+
+# Ограничение частоты команд по классам: cheap – ответ из профиля, lookup – запросы к внешним API,
+# render – графики и выгрузки всего журнала. У каждого класса корзина на пользователя и общая на бота.
+# Лимит задаётся как "токенов в секунду,запас", например THROTTLE_RENDER_USER="0.05,2"
+
+
+def _limit(name, default):
+	rate, burst = os.environ.get(name, default).split(",")
+	return float(rate), float(burst)
+
+
+LIMITS = {
+	"cheap": {"user": _limit("THROTTLE_CHEAP_USER", "1,10"), "global": _limit("THROTTLE_CHEAP_GLOBAL", "50,200")},
+	"lookup": {"user": _limit("THROTTLE_LOOKUP_USER", "0.2,3"), "global": _limit("THROTTLE_LOOKUP_GLOBAL", "5,20")},
+	"render": {"user": _limit("THROTTLE_RENDER_USER", "0.05,2"), "global": _limit("THROTTLE_RENDER_GLOBAL", "1,5")},
+}
+# Общие между инстансами корзины стоят лишнего обращения к хранилищу, поэтому только для дорогих классов
+SHARED_CLASSES = ("lookup", "render")
+PRUNE_SECONDS = 60
+
+
+class Throttle:
+	def __init__(self, limits=LIMITS, shared=None, shared_classes=SHARED_CLASSES,
+			clock=time.monotonic, wall_clock=time.time):
+		# shared(key, func) – чтение-изменение-запись состояния пользователя в общем хранилище;
+		# там время берётся из wall_clock, потому что monotonic у разных процессов своё
+		self.limits = limits
+		self.shared = shared
+		self.shared_classes = shared_classes
+		self.clock = clock
+		self.wall_clock = wall_clock
+		self.user_buckets = {name: {} for name in limits}
+		self.global_buckets = {}
+		self.refused = {}  # (класс, user_id) -> до какого момента пользователь уже предупреждён
+		self.pruned_at = clock()
+		self.lock = threading.Lock()
+
+	def take(self, user_id, command_class, cost=1):
+		# 0 – команду можно выполнять, иначе через сколько секунд повторить
+		user_rate, user_burst = self.limits[command_class]["user"]
+		global_rate, global_burst = self.limits[command_class]["global"]
+		now = self.clock()
+		with self.lock:
+			# Раз в минуту забываем восстановившиеся корзины, чтобы словари не росли
+			if now - self.pruned_at >= PRUNE_SECONDS:
+				self.pruned_at = now
+				self._prune(now)
+			wait = bucket_wait(self.global_buckets, command_class, global_rate, global_burst, now, cost)
+			if wait:
+				return wait
+			if self.shared is None or command_class not in self.shared_classes:
+				wait = bucket_take(self.user_buckets[command_class], user_id, user_rate, user_burst, now, cost)
+				if not wait:
+					self.global_buckets[command_class][0] -= cost
+				return wait
+
+		wait = self._take_shared(user_id, command_class, user_rate, user_burst, cost)
+		if not wait:
+			with self.lock:
+				# Пока шло обращение к хранилищу, общую корзину могли опустошить – тогда чуть превышаем лимит
+				bucket_wait(self.global_buckets, command_class, global_rate, global_burst, self.clock(), cost)
+				self.global_buckets[command_class][0] -= cost
+		return wait
+
+	def _take_shared(self, user_id, command_class, rate, burst, cost):
+		result = {}
+
+		def change(state):
+			state = state or {}
+			result["wait"] = bucket_take(state, command_class, rate, burst, self.wall_clock(), cost)
+			return state
+
+		self.shared(user_id, change)
+		return result["wait"]
+
+	def first_refusal(self, user_id, command_class, wait):
+		# Повторы в пределах одного ожидания склеиваются: отвечаем только на первый
+		now = self.clock()
+		key = (command_class, user_id)
+		with self.lock:
+			if self.refused.get(key, 0) > now:
+				return False
+			self.refused[key] = now + wait
+			return True
+
+	def _prune(self, now):
+		for name, buckets in self.user_buckets.items():
+			rate, burst = self.limits[name]["user"]
+			bucket_prune(buckets, rate, burst, now)
+		for key in [key for key, until in self.refused.items() if until <= now]:
+			del self.refused[key]
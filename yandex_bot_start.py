@@ -1,19 +1,39 @@
 import os
 os.environ["MPLCONFIGDIR"] = "/tmp/matplotlib"
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import requests
 import telebot
 import io
+import re
 import json
 import logging
+import csv
+import gzip
+import zipfile
+import tempfile
+import zlib
 import boto3
-from difflib import get_close_matches
-from datetime import datetime, date, time
+from botocore.exceptions import ClientError
+import profiling
+import metrics
+from breaker import CircuitBreaker, BreakerOpen, CLOSED, HALF_OPEN, OPEN
+import charts
+from reference_bundle import open_bundle
+from send_queue import SendQueue
+from throttle import Throttle
+from difflib import get_close_matches, SequenceMatcher
+from datetime import datetime, date, time, timedelta
 from telebot import types
 from functools import wraps
+from math import gcd, ceil
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 OPENWEATHER_TOKEN = os.environ.get("OPENWEATHER_TOKEN")
@@ -21,8 +41,25 @@ ACCESS_KEY_ID = os.environ.get("ACCESS_KEY_ID")
 SECRET_ACCESS_KEY = os.environ.get("SECRET_ACCESS_KEY")
 DEPLOY_VERSION = os.environ.get("BOT_DEPLOY_VERSION")
 BUCKET_NAME = os.environ.get("BUCKET_NAME", "fitnesstrainer-storage")
-
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+PROFILE_S3_PREFIX = os.environ.get("PROFILE_S3_PREFIX")
+# При PROFILE_SHARED=1 режим, заданный командой /profiling, лежит в бакете, и каждый инстанс перечитывает его
+# раз в PROFILE_SETTINGS_SECONDS. Без него команда меняет режим только у ответившего инстанса и в бакет не ходит
+PROFILE_SHARED = os.environ.get("PROFILE_SHARED", "0") == "1"
+PROFILE_SETTINGS_JSON = "profiling/settings.json"
+PROFILE_SETTINGS_SECONDS = int(os.environ.get("PROFILE_SETTINGS_SECONDS", "30"))
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", "4"))
+SEND_DRAIN_TIMEOUT = float(os.environ.get("SEND_DRAIN_TIMEOUT", "20"))
+# Последний ответ на обновление возвращается прямо в теле ответа вебхука, без отдельного запроса к API
+WEBHOOK_REPLY = os.environ.get("WEBHOOK_REPLY", "0") == "1"
+# Если задана очередь Yandex Message Queue, вебхук только кладёт в неё обновление и сразу отвечает
+UPDATES_QUEUE_URL = os.environ.get("UPDATES_QUEUE_URL")
+
+metrics.inc("bot_cold_starts_total")
+
+bot = telebot.TeleBot(TELEGRAM_TOKEN, threaded=False)
+# Все исходящие сообщения идут через очередь с ограничением скорости
+outbound = SendQueue(bot, workers=SEND_WORKERS)
 
 session = boto3.session.Session()
 s3_client = session.client(
@@ -31,16 +68,66 @@ s3_client = session.client(
 	aws_access_key_id=ACCESS_KEY_ID,
 	aws_secret_access_key=SECRET_ACCESS_KEY
 )
+sqs_client = session.client(
+	service_name='sqs',
+	endpoint_url='https://message-queue.api.cloud.yandex.net',
+	region_name='ru-central1',
+	aws_access_key_id=ACCESS_KEY_ID,
+	aws_secret_access_key=SECRET_ACCESS_KEY
+) if UPDATES_QUEUE_URL else None
 
 users_state = {}
 food_state = {}
+reference_cache = {}  # справочники из бакета, живут до перезапуска инстанса
+food_cache = {}  # ответы OpenFoodFacts по названию продукта
+barcode_cache = {}  # штрихкод -> продукт (или None, если OpenFoodFacts его не знает)
+weather_cache = {"loaded": 0.0, "store": {}}  # копия weather/temperatures.json
+profile_settings_cache = {"loaded": 0.0}  # когда последний раз читали profiling/settings.json
+seen_updates = OrderedDict()  # update_id -> время первой доставки
+done_updates = OrderedDict()  # update_id из очереди, которые уже обработаны
+dedup_stats = {"duplicates": 0}
+# Пока идёт обработка обновления, последнее send_message придерживается здесь
+webhook_reply = {"capture": False, "pending": None}
+# Время до ответа Telegram и полное время от получения обновления до конца обработки, в секундах
+latency_stats = {"ack": deque(maxlen=1000), "end_to_end": deque(maxlen=1000)}
 
 CSV_FILE = "users.csv"
+USERS_PREFIX = "users/"
+USERS_EXPORT_CSV = "users_export.csv"
+BARCODES_PREFIX = "barcodes/"
+# Дедупликация повторных доставок вебхука: память инстанса + общий ключ в бакете на время TTL
+UPDATES_PREFIX = "updates/"
+DEDUP_SHARED = os.environ.get("DEDUP_SHARED", "1") == "1"
+DEDUP_TTL_SECONDS = int(os.environ.get("DEDUP_TTL_SECONDS", "3600"))
+DEDUP_MEMORY_SIZE = int(os.environ.get("DEDUP_MEMORY_SIZE", "10000"))
+# Лимиты частоты команд (throttle.py). При THROTTLE_SHARED=1 корзины дорогих команд пользователя
+# лежат в бакете и общие для всех инстансов, иначе у каждого инстанса свои
+THROTTLE_PREFIX = "throttle/"
+THROTTLE_SHARED = os.environ.get("THROTTLE_SHARED", "0") == "1"
+S3_SCAN_WORKERS = int(os.environ.get("S3_SCAN_WORKERS", "16"))
+FOOD_LOOKUP_WORKERS = int(os.environ.get("FOOD_LOOKUP_WORKERS", "4"))
+FOOD_CACHE_SIZE = int(os.environ.get("FOOD_CACHE_SIZE", "5000"))
+# Сжатие объектов в бакете: "gzip", "zstd" (нужен пакет zstandard) или "none"
+S3_COMPRESSION = os.environ.get("S3_COMPRESSION", "gzip")
+S3_COMPRESS_MIN_BYTES = int(os.environ.get("S3_COMPRESS_MIN_BYTES", "1024"))
 FOOD_CSV = "caloric_products.csv"
 WATER_LOG_CSV = "water_log.csv"
 FOOD_LOG_CSV = "food_log.csv"
+WORKOUT_LOG_CSV = "workout_log.csv"
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "50000"))
 TRAIN_CSV = "train_expenses.csv"
 HEALTH_FOOD_CSV = "health_food.csv"
+# Температуры заранее собирает задача таймера "weather", /log_workout только читает готовое хранилище
+WEATHER_JSON = "weather/temperatures.json"
+CITY_IDS_JSON = "weather/city_ids.json"
+WEATHER_WORKERS = int(os.environ.get("WEATHER_WORKERS", "4"))
+WEATHER_MAX_AGE = int(os.environ.get("WEATHER_MAX_AGE", "10800"))
+WEATHER_CACHE_SECONDS = int(os.environ.get("WEATHER_CACHE_SECONDS", "600"))
+# Бандл справочников собирается build_bundle.py и кладётся в архив функции рядом с кодом
+REFERENCE_BUNDLE = os.environ.get(
+	"REFERENCE_BUNDLE",
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference.bundle")
+)
 
 logging.basicConfig(
 	level=logging.INFO,
@@ -48,8 +135,56 @@ logging.basicConfig(
 	force=True
 )
 logger = logging.getLogger("bot")
+reference_bundle = open_bundle(REFERENCE_BUNDLE)
 if DEPLOY_VERSION:
-	logger.info("БОТ ЗАПУЩЕН. Версия = %s", DEPLOY_VERSION)
+	logger.info(
+		"БОТ ЗАПУЩЕН. Версия = %s, справочники = %s",
+		DEPLOY_VERSION,
+		reference_bundle.version if reference_bundle else "из бакета"
+	)
+
+REPLY_PARAMS = {"reply_markup", "parse_mode", "disable_web_page_preview", "disable_notification"}
+
+def send_message(chat_id, text, **kwargs):
+	if not webhook_reply["capture"] or not set(kwargs) <= REPLY_PARAMS:
+		flush_reply()
+		return outbound.send_message(chat_id, text, **kwargs)
+	# Предыдущее придержанное сообщение уже не последнее – отправляем его через API
+	flush_reply()
+	webhook_reply["pending"] = (chat_id, text, kwargs)
+	future = Future()
+	future.set_result(None)
+	return future
+
+def send_photo(chat_id, photo, **kwargs):
+	flush_reply()
+	return outbound.send_photo(chat_id, photo, **kwargs)
+
+def send_document(chat_id, document, **kwargs):
+	flush_reply()
+	return outbound.send("send_document", chat_id, document, **kwargs)
+
+def flush_reply():
+	pending = webhook_reply["pending"]
+	if pending is not None:
+		webhook_reply["pending"] = None
+		chat_id, text, kwargs = pending
+		outbound.send_message(chat_id, text, **kwargs)
+
+def take_reply():
+	# Тело ответа вебхука: Telegram сам выполнит этот вызов после получения ответа
+	pending = webhook_reply["pending"]
+	webhook_reply["capture"] = False
+	webhook_reply["pending"] = None
+	if pending is None:
+		return None
+	chat_id, text, kwargs = pending
+	reply = {"method": "sendMessage", "chat_id": chat_id, "text": text}
+	for key, value in kwargs.items():
+		if value is None:
+			continue
+		reply[key] = json.loads(value.to_json()) if hasattr(value, "to_json") else value
+	return reply
 
 def log_message(func):
 	@wraps(func)
@@ -58,67 +193,361 @@ def log_message(func):
 			"Получено сообщение: %s",
 			message.text
 		)
+		text = message.text or ""
+		command = text.split()[0].split("@")[0] if text.startswith("/") else "text"
+		metrics.inc("bot_updates_total", command=command)
 		return func(message, *args, **kwargs)
 	return wrapper
 
-def download_from_s3(file_key):
+def change_throttle_state(user_id, func):
+	# Без условной записи: при гонке двух инстансов лимит может немного превыситься, это допустимо
+	file_key = f"{THROTTLE_PREFIX}{user_id}.json"
+	state = func(load_json_from_s3(file_key))
+	upload_to_s3(file_key, json.dumps(state), content_type="application/json")
+	return state
+
+throttle = Throttle(shared=change_throttle_state if THROTTLE_SHARED else None)
+
+def allow_command(chat_id, command_class):
+	wait = throttle.take(chat_id, command_class)
+	if not wait:
+		return True
+	metrics.inc("bot_throttled_total", command_class=command_class)
+	# На серию повторов – одно предупреждение, остальные до конца ожидания молча пропускаем
+	if throttle.first_refusal(chat_id, command_class, wait):
+		send_message(chat_id, f"⏳ Слишком часто. Повторите через {ceil(wait)} с")
+	return False
+
+def throttled(command_class):
+	def decorator(func):
+		@wraps(func)
+		def wrapper(message, *args, **kwargs):
+			chat_id = message.message.chat.id if isinstance(message, types.CallbackQuery) else message.chat.id
+			if not allow_command(chat_id, command_class):
+				return
+			return func(message, *args, **kwargs)
+		return wrapper
+	return decorator
+
+def compress_body(data):
+	if len(data) < S3_COMPRESS_MIN_BYTES:
+		return data, None
+	if S3_COMPRESSION == "gzip":
+		return gzip.compress(data, compresslevel=6), "gzip"
+	if S3_COMPRESSION == "zstd" and zstandard is not None:
+		return zstandard.ZstdCompressor(level=3).compress(data), "zstd"
+	return data, None
+
+def decompress_body(data, encoding):
+	# Старые объекты лежат без сжатия и без Content-Encoding – их отдаём как есть
+	if encoding == "gzip" or data[:2] == b"\x1f\x8b":
+		return gzip.decompress(data)
+	if encoding == "zstd":
+		if zstandard is None:
+			raise RuntimeError("zstandard is required to read zstd objects")
+		return zstandard.ZstdDecompressor().decompress(data)
+	return data
+
+def download_from_s3(file_key, missing_ok=False):
 	try:
+		metrics.inc("bot_s3_operations_total", op="get")
 		response = s3_client.get_object(Bucket=BUCKET_NAME, Key=file_key)
-		return response['Body'].read().decode('utf-8')
+		raw = response['Body'].read()
+		metrics.inc("bot_s3_bytes_total", len(raw), op="get")
+		data = decompress_body(raw, response.get('ContentEncoding'))
+		return data.decode('utf-8')
+	except s3_client.exceptions.NoSuchKey:
+		if not missing_ok:
+			logger.error(f"Object {file_key} not found")
+		return None
 	except Exception as e:
 		logger.exception(f"Error downloading {file_key}: {e}")
 		return None
 
-def upload_to_s3(file_key, content):
+def upload_to_s3(file_key, content, content_type='text/csv'):
 	try:
+		if isinstance(content, str):
+			content = content.encode('utf-8')
+		body, encoding = compress_body(content)
+		extra = {'ContentEncoding': encoding} if encoding else {}
+		metrics.inc("bot_s3_operations_total", op="put")
+		metrics.inc("bot_s3_bytes_total", len(body), op="put")
 		s3_client.put_object(
 			Bucket=BUCKET_NAME,
 			Key=file_key,
-			Body=content,
-			ContentType='text/csv'
+			Body=body,
+			ContentType=content_type,
+			**extra
 		)
 		return True
 	except Exception as e:
 		logger.exception(f"Error uploading {file_key}: {e}")
 		return False
 
-def load_df_from_s3(file_key):
+# Профили медленных обновлений складываем в бакет, чтобы их можно было забрать для flame graph
+if PROFILE_S3_PREFIX:
+	profiling.sink = lambda file_name, data: upload_to_s3(
+		f"{PROFILE_S3_PREFIX.rstrip('/')}/{file_name}", data, 'application/octet-stream'
+	)
+
+def open_s3_stream(file_key):
+	# Читаем объект потоково, не загружая его целиком в память
+	metrics.inc("bot_s3_operations_total", op="get_stream")
+	try:
+		response = s3_client.get_object(Bucket=BUCKET_NAME, Key=file_key)
+	except s3_client.exceptions.NoSuchKey:
+		return None
+	body = response['Body']
+	encoding = response.get('ContentEncoding')
+	if encoding == "gzip":
+		body = gzip.GzipFile(fileobj=body)
+	elif encoding == "zstd":
+		if zstandard is None:
+			body.close()
+			raise RuntimeError("zstandard is required to read zstd objects")
+		body = zstandard.ZstdDecompressor().stream_reader(body)
+	return io.TextIOWrapper(body, encoding="utf-8")
+
+def iter_user_rows(file_key, user_id, date_from=None, date_to=None):
+	stream = open_s3_stream(file_key)
+	if stream is None:
+		return
+	key = user_key(user_id)
+	with stream:
+		for chunk in pd.read_csv(stream, chunksize=EXPORT_CHUNK_ROWS, dtype={"user_id": str}):
+			# ISO-даты сравниваем как строки, без разбора каждой строки в datetime
+			mask = chunk["user_id"] == key
+			if date_from:
+				mask &= chunk["datetime"] >= date_from
+			if date_to:
+				mask &= chunk["datetime"] < date_to
+			if mask.any():
+				yield chunk[mask]
+
+def load_df_from_s3(file_key, dtype=None):
 	content = download_from_s3(file_key)
 	if content:
-		return pd.read_csv(io.StringIO(content))
+		return pd.read_csv(io.StringIO(content), dtype=dtype)
 	return pd.DataFrame()
 
-def save_df_to_s3(df, file_key):
+def save_df_to_s3(df, file_key, index=False):
 	csv_buffer = io.StringIO()
-	df.to_csv(csv_buffer, index=False)
+	df.to_csv(csv_buffer, index=index)
 	upload_to_s3(file_key, csv_buffer.getvalue())
 
-def load_users():
-	return load_df_from_s3(CSV_FILE)
+# Явная схема таблицы пользователей: user_id всегда строка (в файле есть и "user_1", и id чатов)
+USER_COLUMNS = {
+	"user_id": str,
+	"gender": str,
+	"weight": float,
+	"height": "Int64",
+	"age": "Int64",
+	"activity": "Int64",
+	"city": str,
+	"city_id": "Int64",
+	"calorie_mode": str,
+	"calorie_goal": "Int64",
+	"water_goal": float,
+	"logged_water": "Int64",
+	"logged_calories": float,
+	"burned_calories": "Int64",
+	"last_reset_date": str,
+}
+DAILY_COUNTERS = ["logged_water", "logged_calories", "burned_calories"]
+
+def user_key(user_id):
+	return str(user_id)
+
+def index_users(df):
+	# Приводим типы один раз при загрузке и строим индекс по user_id, чтобы поиск был O(1)
+	for column, dtype in USER_COLUMNS.items():
+		if column not in df.columns:
+			df[column] = pd.Series(dtype=dtype)
+		elif dtype == "Int64":
+			df[column] = pd.to_numeric(df[column], errors="coerce").round().astype("Int64")
+		elif dtype is float:
+			df[column] = pd.to_numeric(df[column], errors="coerce")
+		else:
+			df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+	return df.drop_duplicates("user_id", keep="last").set_index("user_id")
+
+def user_object_key(user_id):
+	return f"{USERS_PREFIX}{user_key(user_id)}.json"
+
+def user_to_json(data):
+	clean = {
+		column: None if value is pd.NA or (isinstance(value, float) and value != value) else value
+		for column, value in data.items()
+	}
+	# numpy-типы из DataFrame превращаем в обычные числа
+	return json.dumps(clean, ensure_ascii=False, default=lambda value: value.item())
+
+def load_user(user_id):
+	# Каждая команда читает только свой маленький объект, а не всю таблицу
+	content = download_from_s3(user_object_key(user_id), missing_ok=True)
+	if not content:
+		return None
+	return json.loads(content)
 
 def save_user(data):
-	df = load_users()
-	if not df.empty and "user_id" in df.columns:
-		df = df[df.user_id != data["user_id"]]
-	df = pd.concat([df, pd.DataFrame([data])], ignore_index=True)
-	save_df_to_s3(df, CSV_FILE)
+	upload_to_s3(user_object_key(data["user_id"]), user_to_json(data), 'application/json')
+
+def list_user_keys():
+	keys = []
+	paginator = s3_client.get_paginator("list_objects_v2")
+	for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=USERS_PREFIX):
+		keys.extend(item["Key"] for item in page.get("Contents", []) if item["Key"].endswith(".json"))
+	return keys
+
+def load_users():
+	# Полный проход по пользователям – только для пакетных задач и выгрузок
+	with ThreadPoolExecutor(max_workers=S3_SCAN_WORKERS) as pool:
+		contents = list(pool.map(download_from_s3, list_user_keys()))
+	df = pd.DataFrame([json.loads(content) for content in contents if content])
+	return index_users(df)
+
+def user_records(df):
+	# Записи в том виде, в каком они лежат в хранилище, чтобы сравнивать с перечитанными
+	return {row["user_id"]: json.loads(user_to_json(row)) for row in df.reset_index().to_dict("records")}
+
+def patch_user(row, before):
+	# Пока шла пакетная задача, пользователь мог что-то записать командой. Перечитываем объект
+	# и переносим только поля, которые поменяла задача. Если команда успела изменить хоть одно
+	# из них, результат задачи устарел: пользователя пропускаем, его обработает следующий запуск
+	old = before.get(row["user_id"])
+	user = load_user(row["user_id"])
+	if old is None or user is None:
+		return False
+	new = json.loads(user_to_json(row))
+	fields = {column: value for column, value in new.items() if value != old.get(column)}
+	if not fields or any(user.get(column) != old.get(column) for column in fields):
+		return False
+	user.update(fields)
+	save_user(user)
+	return True
+
+def save_users(df, user_ids, before):
+	rows = df.loc[list(user_ids)].reset_index().to_dict("records")
+	with ThreadPoolExecutor(max_workers=S3_SCAN_WORKERS) as pool:
+		return sum(pool.map(lambda row: patch_user(row, before), rows))
+
+def load_legacy_users():
+	df = load_df_from_s3(CSV_FILE, dtype={"user_id": str, "last_reset_date": str})
+	return index_users(df)
+
+def migrate_users_csv():
+	# Разбиваем старый users.csv на объекты users/<chat_id>.json
+	df = load_legacy_users()
+	infer_calorie_modes(df)
+	# Уже созданные объекты новее старой таблицы: переносим только недостающих пользователей
+	existing = set(list_user_keys())
+	rows = [row for row in df.reset_index().to_dict("records") if user_object_key(row["user_id"]) not in existing]
+	with ThreadPoolExecutor(max_workers=S3_SCAN_WORKERS) as pool:
+		list(pool.map(save_user, rows))
+	return len(rows)
 
 def reset_daily_if_needed(user_id):
-	df = load_users()
-	if df.empty:
-		return
+	user = load_user(user_id)
+	if user is None:
+		return None
 
 	today = date.today().isoformat()
+	changed = advance_trends(user, today)
+	if user.get("last_reset_date") != today:
+		for column in DAILY_COUNTERS:
+			user[column] = 0
+		user["last_reset_date"] = today
+		changed = True
+	if changed:
+		save_user(user)
+	return user
+
+# Скользящая статистика по дням: days[0] – сегодня, days[1..30] – прошедшие дни.
+# Суммы за 7 и 30 дней, EWMA и серию обновляем при смене дня, а не пересчитываем по журналам
+TREND_DAYS = 30
+TREND_EWMA_ALPHA = 0.3
+TREND_GOALS = {
+	"water": ("water_goal", lambda total, goal: total >= goal),
+	"calories": ("calorie_goal", lambda total, goal: 0 < total <= goal),
+}
+
+def new_trend():
+	return {"days": [0.0] * (TREND_DAYS + 1), "sum7": 0.0, "sum30": 0.0, "ewma": None, "streak": 0, "tracked": 0}
+
+def roll_trend(trend, goal, goal_met):
+	days = trend["days"]
+	completed = days[0]
+	trend["sum7"] += completed - days[7]
+	trend["sum30"] += completed - days[30]
+	trend["days"] = [0.0] + days[:-1]
+	trend["ewma"] = completed if trend["ewma"] is None else TREND_EWMA_ALPHA * completed + (1 - TREND_EWMA_ALPHA) * trend["ewma"]
+	trend["streak"] = trend["streak"] + 1 if goal and goal_met(completed, goal) else 0
+	trend["tracked"] = min(trend["tracked"] + 1, TREND_DAYS)
+
+def advance_trends(user, today):
+	trends = user.get("trends")
+	if not isinstance(trends, dict) or trends.get("day") == today:
+		return False
 
-	if user_id in df['user_id'].values:
-		user = df[df.user_id == user_id].iloc[0]
-		last_reset = user.get("last_reset_date", "")
-		
-		if last_reset != today:
-			mask = df.user_id == user_id
-			df.loc[mask, ["logged_water", "logged_calories", "burned_calories"]] = 0
-			df.loc[mask, "last_reset_date"] = today
-			save_df_to_s3(df, CSV_FILE)
+	# Пропущенные дни сдвигаем как нулевые; больше 31 сдвига ничего не меняет
+	gap = (date.fromisoformat(today) - date.fromisoformat(trends["day"])).days
+	for _ in range(min(max(gap, 0), TREND_DAYS + 1)):
+		for metric, (goal_column, goal_met) in TREND_GOALS.items():
+			goal = user.get(goal_column)
+			roll_trend(trends[metric], float(goal) if goal is not None and pd.notna(goal) else 0, goal_met)
+	trends["day"] = today
+	return True
+
+def record_trend(user, metric, amount):
+	today = date.today().isoformat()
+	if not isinstance(user.get("trends"), dict):
+		user["trends"] = {"day": today, **{name: new_trend() for name in TREND_GOALS}}
+	advance_trends(user, today)
+	user["trends"][metric]["days"][0] += amount
+
+def trend_summary(trend):
+	tracked = trend["tracked"]
+	return {
+		"today": trend["days"][0],
+		"mean7": trend["sum7"] / min(tracked, 7) if tracked else None,
+		"mean30": trend["sum30"] / tracked if tracked else None,
+		"ewma": trend["ewma"],
+		"streak": trend["streak"],
+	}
+
+def trend_delta_text(summary, unit):
+	mean = summary["mean7"]
+	if not mean:
+		return None
+	percent = (summary["today"] - mean) / mean * 100
+	direction = "выше" if percent >= 0 else "ниже"
+	return f"на {abs(percent):.0f}% {direction} среднего за 7 дней ({int(mean)} {unit})"
+
+def reset_daily_all(df, today):
+	# Один проход по всей таблице вместо ленивого сброса у каждого пользователя
+	if df.empty:
+		return df.index
+	stale = df["last_reset_date"] != today
+	if "trends" in df.columns:
+		for key in df.index[stale.to_numpy()]:
+			row = {column: df.at[key, column] for column in ["trends", "water_goal", "calorie_goal"]}
+			advance_trends(row, today)
+	df.loc[stale, DAILY_COUNTERS] = 0
+	df.loc[stale, "last_reset_date"] = today
+	return df.index[stale.to_numpy()]
+
+def collect_water_reminders(df, today):
+	if df.empty:
+		return []
+
+	chat_ids = pd.Series(pd.to_numeric(df.index, errors="coerce"), index=df.index)
+	left = df["water_goal"] - df["logged_water"].astype(float)
+	mask = chat_ids.notna() & (left > 0) & (df["last_reset_date"] == today)
+
+	return [
+		(int(chat_id), f"💧 Не забудьте про воду! До нормы осталось {int(ml)} мл")
+		for chat_id, ml in zip(chat_ids[mask], left[mask])
+	]
 
 def calculate_bmr(gender, weight, height, age):
 	if gender == "m":
@@ -141,61 +570,375 @@ def activity_multiplier(minutes):
 def water_norm(weight):
 	return weight * 30
 
-def get_city_temperature(city):
-	url = (
-		"https://api.openweathermap.org/data/2.5/weather"
-		f"?q={city}&appid={OPENWEATHER_TOKEN}&units=metric&lang=ru"
+def calculate_goals_bulk(df):
+	# Те же формулы, что calculate_bmr / activity_multiplier / water_norm, но сразу для всей таблицы
+	weight = df["weight"].to_numpy(dtype=float, na_value=np.nan)
+	height = df["height"].to_numpy(dtype=float, na_value=np.nan)
+	age = df["age"].to_numpy(dtype=float, na_value=np.nan)
+	activity = df["activity"].to_numpy(dtype=float, na_value=np.nan)
+
+	bmr = 10 * weight + 6.25 * height - 5 * age + np.where(df["gender"].to_numpy() == "m", 5, -161)
+	multiplier = np.select(
+		[activity < 20, activity < 40, activity < 60, activity < 90],
+		[1.2, 1.375, 1.55, 1.725],
+		1.9
 	)
+	return np.trunc(bmr * multiplier), water_norm(weight)
+
+def infer_calorie_modes(df):
+	# В старых записях режима нет. Пока формула та же, что при заполнении профиля, ручную цель видно
+	# по несовпадению с формулой, поэтому режим сохраняем при переносе, а не угадываем после её изменения
+	if df.empty:
+		return df
+	calories, _ = calculate_goals_bulk(df)
+	old_calories = df["calorie_goal"].to_numpy(dtype=float, na_value=np.nan)
+	missing = df["calorie_mode"].isna()
+	df.loc[missing, "calorie_mode"] = np.where(old_calories == calories, "auto", "manual")[missing.to_numpy()]
+	return df
+
+def recompute_goals(df, dry_run=False):
+	if df.empty:
+		return pd.DataFrame(columns=["user_id", "old_calorie_goal", "calorie_goal", "old_water_goal", "water_goal"])
+
+	calories, water = calculate_goals_bulk(df)
+	old_calories = df["calorie_goal"].to_numpy(dtype=float, na_value=np.nan)
+	old_water = df["water_goal"].to_numpy(dtype=float, na_value=np.nan)
+
+	# Режим без значения – автоматический: ручные цели старых записей помечает migrate_users
+	auto = (df["calorie_mode"] != "manual").to_numpy()
+
+	valid = ~np.isnan(calories)
+	new_calories = np.where(auto & valid, calories, old_calories)
+	new_water = np.where(~np.isnan(water), water, old_water)
+
+	changed = (new_calories != old_calories) | (new_water != old_water)
+	diff = pd.DataFrame({
+		"user_id": df.index.to_numpy()[changed],
+		"old_calorie_goal": old_calories[changed],
+		"calorie_goal": new_calories[changed],
+		"old_water_goal": old_water[changed],
+		"water_goal": new_water[changed],
+	})
+
+	if not dry_run:
+		df["calorie_goal"] = pd.Series(new_calories, index=df.index).astype("Int64")
+		df["water_goal"] = new_water
+		df["calorie_mode"] = np.where(auto, "auto", "manual")
+	return diff
+
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+def breaker_changed(name, previous, state):
+	metrics.inc("bot_breaker_transitions_total", upstream=name, to=state)
+	metrics.set_gauge("bot_breaker_state", BREAKER_STATE_VALUES[state], upstream=name)
+
+# Свой размыкатель на каждый внешний API: пока он разомкнут, запросы не отправляются
+breakers = {}
+for upstream_name in ("openfoodfacts", "openweather"):
+	breakers[upstream_name] = CircuitBreaker(upstream_name, on_change=breaker_changed)
+	metrics.set_gauge("bot_breaker_state", 0, upstream=upstream_name)
+
+class LookupFailed(Exception):
+	# Временная ошибка внешнего API, в отличие от ответа «не найдено»
+	pass
+
+def upstream_failed(response):
+	return response.status_code >= 500 or response.status_code == 429
+
+def upstream_get(upstream, url, **kwargs):
+	# Все запросы к внешним API идут здесь, чтобы считать их время и ошибки.
+	# Разомкнутый размыкатель сразу бросает BreakerOpen, и вызывающий берёт запасной вариант
+	def get():
+		with metrics.timer("bot_upstream_seconds", upstream=upstream):
+			return requests.get(url, **kwargs)
+
 	try:
-		response = requests.get(url, timeout=5)
+		response = breakers[upstream].call(get, failed=upstream_failed)
+	except BreakerOpen:
+		metrics.inc("bot_breaker_rejected_total", upstream=upstream)
+		raise
+	except Exception:
+		metrics.inc("bot_upstream_errors_total", upstream=upstream)
+		raise
+	if upstream_failed(response):
+		metrics.inc("bot_upstream_errors_total", upstream=upstream)
+	return response
+
+OPENWEATHER_URL = "https://api.openweathermap.org/data/2.5"
+WEATHER_GROUP_SIZE = 20  # столько id городов принимает один запрос /group
+
+def fetch_city_weather(city):
+	# Запрос по названию возвращает и id города, и текущую погоду.
+	# {} – OpenWeather такого города не знает, None – временная ошибка
+	try:
+		response = upstream_get(
+			"openweather",
+			f"{OPENWEATHER_URL}/weather",
+			params={"q": city, "appid": OPENWEATHER_TOKEN, "units": "metric", "lang": "ru"},
+			timeout=5
+		)
 		if response.status_code == 200:
-			data = response.json()
-			return data["main"]["temp"]
+			return response.json()
+		if response.status_code == 404:
+			return {}
+	except BreakerOpen:
+		pass
 	except Exception as e:
 		logger.error(f"Error getting temperature: {e}")
 	return None
 
+def fetch_group_weather(city_ids):
+	response = upstream_get(
+		"openweather",
+		f"{OPENWEATHER_URL}/group",
+		params={"id": ",".join(city_ids), "appid": OPENWEATHER_TOKEN, "units": "metric"},
+		timeout=10
+	)
+	response.raise_for_status()
+	return {str(item["id"]): item["main"]["temp"] for item in response.json().get("list", [])}
+
+def load_json_from_s3(file_key):
+	content = download_from_s3(file_key, missing_ok=True)
+	return json.loads(content) if content else {}
+
+def known_city_id(city):
+	return load_json_from_s3(CITY_IDS_JSON).get(normalize_name(city))
+
+def prefetch_weather(df):
+	# Возвращает user_id, у которых появился или поменялся city_id
+	city_ids = load_json_from_s3(CITY_IDS_JSON)
+	names = {}
+	for city in df["city"].dropna().unique():
+		if str(city).strip():
+			names.setdefault(normalize_name(city), city)
+
+	now = datetime.now().timestamp()
+	temperatures = {}
+	with ThreadPoolExecutor(max_workers=WEATHER_WORKERS) as pool:
+		# Свободный текст переводим в id один раз, дальше город запрашивается только по id
+		unknown = [name for name in names if name not in city_ids]
+		for name, data in zip(unknown, pool.map(fetch_city_weather, [names[name] for name in unknown])):
+			if data is None:
+				continue
+			city_ids[name] = data.get("id")
+			if data:
+				temperatures[str(data["id"])] = data["main"]["temp"]
+		if unknown:
+			upload_to_s3(CITY_IDS_JSON, json.dumps(city_ids, ensure_ascii=False), 'application/json')
+
+		known = sorted({str(city_ids[name]) for name in names if city_ids.get(name)} - set(temperatures))
+		chunks = [known[i:i + WEATHER_GROUP_SIZE] for i in range(0, len(known), WEATHER_GROUP_SIZE)]
+		for future in [pool.submit(fetch_group_weather, chunk) for chunk in chunks]:
+			try:
+				temperatures.update(future.result())
+			except Exception as e:
+				logger.error(f"Error getting group weather: {e}")
+
+	# Города, которые сейчас не ответили, сохраняют прошлое значение до WEATHER_MAX_AGE
+	store = load_json_from_s3(WEATHER_JSON)
+	cities = store.setdefault("cities", {})
+	for city_id, temp in temperatures.items():
+		cities[city_id] = {"temp": temp, "updated": now}
+	store["updated"] = now
+	upload_to_s3(WEATHER_JSON, json.dumps(store), 'application/json')
+
+	ids = pd.array(
+		[city_ids.get(normalize_name(city)) if isinstance(city, str) else None for city in df["city"]],
+		dtype="Int64"
+	)
+	ids = pd.Series(ids, index=df.index)
+	stale = ids.notna() & (df["city_id"].fillna(-1) != ids.fillna(-1))
+	df.loc[stale, "city_id"] = ids[stale]
+	logger.info("Погода: городов %s, температур обновлено %s", len(names), len(temperatures))
+	return df.index[stale]
+
+def stored_temperature(user):
+	city_id = user.get("city_id")
+	if city_id is None:
+		return None
+	now = datetime.now().timestamp()
+	stale = now - weather_cache["loaded"] > WEATHER_CACHE_SECONDS
+	metrics.inc("bot_cache_requests_total", cache="weather", result="miss" if stale else "hit")
+	if stale:
+		weather_cache["store"] = load_json_from_s3(WEATHER_JSON)
+		weather_cache["loaded"] = now
+	entry = weather_cache["store"].get("cities", {}).get(str(int(city_id)))
+	if entry is None or now - entry["updated"] > WEATHER_MAX_AGE:
+		return None
+	return entry["temp"]
+
+def normalize_name(name):
+	return " ".join(name.strip().lower().split())
+
+def reference_table(file_key):
+	return reference_bundle.table(file_key) if reference_bundle else None
+
+def load_reference(file_key):
+	# Справочники меняются редко: берём их из бандла, а без него скачиваем один раз на инстанс
+	df = reference_cache.get(file_key)
+	metrics.inc("bot_cache_requests_total", cache="reference", result="miss" if df is None else "hit")
+	if df is None:
+		table = reference_table(file_key)
+		if table is not None:
+			df = pd.DataFrame({
+				column: table.column(column)
+				for column in table.meta["columns"] if not column.startswith("_")
+			})
+		else:
+			df = load_df_from_s3(file_key)
+		if not df.empty:
+			reference_cache[file_key] = df
+	return df
+
+def match_reference(file_key, name_column, query):
+	# Возвращает номер строки справочника с самым похожим названием или None
+	table = reference_table(file_key)
+	if table is not None:
+		return table.match(query)
+
+	df = load_reference(file_key)
+	if df.empty:
+		return None
+	names = reference_cache.get((file_key, "names"))
+	if names is None:
+		names = reference_cache[(file_key, "names")] = df[name_column].str.strip().str.lower().tolist()
+	matches = get_close_matches(normalize_name(query), names, n=1, cutoff=0.6)
+	return names.index(matches[0]) if matches else None
+
+def cached_food_info(product_name):
+	key = normalize_name(product_name)
+	if key in food_cache:
+		metrics.inc("bot_cache_requests_total", cache="food", result="hit")
+		return food_cache[key]
+	metrics.inc("bot_cache_requests_total", cache="food", result="miss")
+	try:
+		food = get_food_info(product_name)
+	except (BreakerOpen, LookupFailed):
+		# OpenFoodFacts недоступен или ответил ошибкой: не кэшируем, продукт найдётся в локальном справочнике
+		return None
+	if len(food_cache) >= FOOD_CACHE_SIZE:
+		food_cache.pop(next(iter(food_cache)))
+	food_cache[key] = food
+	return food
+
 def get_food_info(product_name):
 	url = (
 		"https://world.openfoodfacts.org/cgi/search.pl"
 		f"?action=process&search_terms={product_name}&json=true&page_size=5"
 	)
 	try:
-		response = requests.get(url, timeout=10)
-		if response.status_code == 200:
-			data = response.json()
-			products = data.get("products", [])
-			for product in products:
-				calories = product.get("nutriments", {}).get("energy-kcal_100g")
-				name = product.get("product_name")
-				if calories and name:
-					return {
-						"name": name,
-						"calories": float(calories)
-					}
+		response = upstream_get("openfoodfacts", url, timeout=10)
+		if response.status_code != 200:
+			raise LookupFailed(f"status {response.status_code}")
+		data = response.json()
+		products = data.get("products", [])
+		for product in products:
+			calories = product.get("nutriments", {}).get("energy-kcal_100g")
+			name = product.get("product_name")
+			if calories and name:
+				return {
+					"name": name,
+					"calories": float(calories)
+				}
+	except BreakerOpen:
+		raise
 	except Exception as e:
 		logger.error(f"Error getting food info: {e}")
+		raise LookupFailed(str(e))
+	# Настоящий ответ «не найдено» – его можно кэшировать
 	return None
 
-def get_food_from_csv(product_name):
-	df = load_df_from_s3(FOOD_CSV)
-	if df.empty:
-		return None
+def get_food_by_barcode(barcode):
+	# Порядок: память инстанса -> общий кэш в бакете -> точный запрос к OpenFoodFacts
+	if barcode in barcode_cache:
+		metrics.inc("bot_cache_requests_total", cache="barcode", result="hit")
+		return barcode_cache[barcode]
+	metrics.inc("bot_cache_requests_total", cache="barcode", result="miss")
 
-	user_input = product_name.strip().lower()
-	products = df["product_name"].str.strip().str.lower().tolist()
+	content = download_from_s3(f"{BARCODES_PREFIX}{barcode}.json", missing_ok=True)
+	if content:
+		food = json.loads(content)
+	else:
+		try:
+			food = get_food_info_by_barcode(barcode)
+		except (BreakerOpen, LookupFailed):
+			# Временную ошибку не запоминаем, иначе штрихкод «не найден» до вытеснения из кэша
+			return None
+		if food:
+			upload_to_s3(f"{BARCODES_PREFIX}{barcode}.json", json.dumps(food, ensure_ascii=False), 'application/json')
+
+	if len(barcode_cache) >= FOOD_CACHE_SIZE:
+		barcode_cache.pop(next(iter(barcode_cache)))
+	barcode_cache[barcode] = food
+	return food
+
+def get_food_info_by_barcode(barcode):
+	url = (
+		f"https://world.openfoodfacts.org/api/v2/product/{barcode}.json"
+		"?fields=product_name,nutriments"
+	)
+	try:
+		response = upstream_get("openfoodfacts", url, timeout=10)
+		# 404 – OpenFoodFacts не знает такой штрихкод
+		if response.status_code == 404:
+			return None
+		if response.status_code != 200:
+			raise LookupFailed(f"status {response.status_code}")
+		product = response.json().get("product") or {}
+		calories = product.get("nutriments", {}).get("energy-kcal_100g")
+		name = product.get("product_name")
+		if calories and name:
+			return {
+				"name": name,
+				"calories": float(calories)
+			}
+	except BreakerOpen:
+		raise
+	except Exception as e:
+		logger.error(f"Error getting food by barcode: {e}")
+		raise LookupFailed(str(e))
+	return None
 
-	matches = get_close_matches(user_input, products, n=1, cutoff=0.6)
+def get_food_from_csv(product_name):
+	return match_catalog([product_name]).get(product_name)
 
-	if matches:
-		matched = matches[0]
-		row = df[df.product_name.str.lower() == matched].iloc[0]
-		return {
-			"name": row.product_name,
-			"calories": float(row.energy_kcal_100g)
-		}
+def match_catalog(product_names):
+	# Один проход по локальному справочнику для всех позиций сразу
+	df = load_reference(FOOD_CSV)
+	if df.empty:
+		return {}
+
+	found = {}
+	for product_name in product_names:
+		row_number = match_reference(FOOD_CSV, "product_name", product_name)
+		if row_number is not None:
+			row = df.iloc[row_number]
+			found[product_name] = {
+				"name": row.product_name,
+				"calories": float(row.energy_kcal_100g)
+			}
+	return found
+
+def resolve_foods(product_names):
+	# Сначала локальный справочник и кэш OpenFoodFacts, остальное запрашиваем параллельно
+	found = match_catalog(product_names)
+	remote = []
+	for product_name in product_names:
+		if product_name in found:
+			continue
+		key = normalize_name(product_name)
+		if key in food_cache:
+			if food_cache[key]:
+				found[product_name] = food_cache[key]
+		else:
+			remote.append(product_name)
 
-	return None
+	if remote:
+		with ThreadPoolExecutor(max_workers=FOOD_LOOKUP_WORKERS) as pool:
+			for product_name, food in zip(remote, pool.map(cached_food_info, remote)):
+				if food:
+					found[product_name] = food
+	return found
 
 def append_water_log(user_id, amount):
 	water_df = load_df_from_s3(WATER_LOG_CSV)
@@ -215,15 +958,22 @@ def append_water_log(user_id, amount):
 	save_df_to_s3(water_df, WATER_LOG_CSV)
 
 def append_food_log(user_id, calories):
+	append_food_log_rows(user_id, [calories])
+
+def append_food_log_rows(user_id, calories_list):
 	food_df = load_df_from_s3(FOOD_LOG_CSV)
 
-	row = {
-		"user_id": user_id,
-		"datetime": datetime.now().isoformat(),
-		"calories": calories
-	}
+	now = datetime.now().isoformat()
+	rows = [
+		{
+			"user_id": user_id,
+			"datetime": now,
+			"calories": calories
+		}
+		for calories in calories_list
+	]
 
-	new_df = pd.DataFrame([row])
+	new_df = pd.DataFrame(rows)
 	if not food_df.empty:
 		food_df = pd.concat([food_df, new_df], ignore_index=True)
 	else:
@@ -231,21 +981,67 @@ def append_food_log(user_id, calories):
 
 	save_df_to_s3(food_df, FOOD_LOG_CSV)
 
-def send_plot_as_photo(chat_id, plot_func):
+def append_workout_log(user_id, train_type, minutes, calories):
+	workout_df = load_df_from_s3(WORKOUT_LOG_CSV)
+
+	row = {
+		"user_id": user_id,
+		"datetime": datetime.now().isoformat(),
+		"train_type": train_type,
+		"minutes": minutes,
+		"calories": calories
+	}
+
+	new_df = pd.DataFrame([row])
+	if not workout_df.empty:
+		workout_df = pd.concat([workout_df, new_df], ignore_index=True)
+	else:
+		workout_df = new_df
+
+	save_df_to_s3(workout_df, WORKOUT_LOG_CSV)
+
+def export_user_history(user_id, out, date_from=None, date_to=None):
+	# out – текстовый файл, в который построчно пишем историю в одном формате для всех журналов
+	writer = csv.writer(out)
+	writer.writerow(["type", "datetime", "value", "unit", "details"])
+	rows = 0
+	sources = [
+		("water", WATER_LOG_CSV, "amount_ml", "мл"),
+		("food", FOOD_LOG_CSV, "calories", "ккал"),
+		("workout", WORKOUT_LOG_CSV, "calories", "ккал"),
+	]
+	for kind, file_key, value_column, unit in sources:
+		for chunk in iter_user_rows(file_key, user_id, date_from, date_to):
+			if kind == "workout":
+				details = chunk["train_type"].astype(str) + ", " + chunk["minutes"].astype(str) + " мин"
+			else:
+				details = [""] * len(chunk)
+			writer.writerows(zip([kind] * len(chunk), chunk["datetime"], chunk[value_column], [unit] * len(chunk), details))
+			rows += len(chunk)
+	return rows
+
+def today_series(file_key, user_id, value_column):
+	# Записи пользователя за сегодня в виде массивов для графика; None, если журнала ещё нет
+	df = load_df_from_s3(file_key, dtype={"user_id": str})
+	if df.empty:
+		return None
+	df["datetime"] = pd.to_datetime(df["datetime"])
+	df = df[
+		(df.user_id == user_key(user_id)) &
+		(df.datetime >= datetime.combine(date.today(), time.min))
+	]
+	return charts.chart_series(df, value_column)
+
+def send_chart(chat_id, *chart_args):
 	try:
-		buf = io.BytesIO()
-		plot_func()
-		plt.savefig(buf, format="png", dpi=100)
-		buf.seek(0)
-		plt.close()
-		bot.send_photo(chat_id, buf)
-		buf.close()
+		send_photo(chat_id, charts.render_chart(*chart_args))
 	except Exception as e:
-		bot.send_message(chat_id, f"Ошибка при создании графика: {str(e)}")
+		send_message(chat_id, f"Ошибка при создании графика: {str(e)}")
 		logger.error(f"Plot error: {e}")
 
 @bot.message_handler(commands=["start"])
 @log_message
+@throttled("cheap")
 def start(message):
 	user = message.from_user
 	text = (
@@ -260,10 +1056,11 @@ def start(message):
 	btn_myfav = types.KeyboardButton("📊 Статистика")
 	keyboard.add(btn_top, btn_myfav)
 
-	bot.send_message(message.chat.id, text, reply_markup=keyboard)
+	send_message(message.chat.id, text, reply_markup=keyboard)
 
 @bot.message_handler(commands=["help"])
 @log_message
+@throttled("cheap")
 def help_command(message):
 	text = (
 		"Доступные команды:\n"
@@ -272,24 +1069,31 @@ def help_command(message):
 		"/set_profile – настройка профиля пользователя\n"
 		"/log_water <мл> – сохраняем объём выпитой воды\n"
 		"/log_food <название продукта> – записываем еду, которую вы съели\n"
+		"/log_food 200г гречка, 2 яйца – записываем сразу несколько продуктов\n"
+		"/log_food <штрихкод> – ищем продукт по штрихкоду\n"
+		"/log_food – недавние продукты, записываются одним нажатием\n"
 		"/log_workout <тип> <минуты> – фиксируем сожжённые калории\n"
 		"/check_progress – показывает, сколько воды и калорий потреблено, сожжено и сколько осталось до выполнения цели\n"
+		"/trends – средние значения за 7 и 30 дней и серия выполненных норм\n"
 		"/profile - информация об аккаунте\n"
 		"/stats – выводим графики потребления воды и съеденной еды\n"
+		"/export [с] [по] [zip] – выгрузка вашей истории в CSV\n"
 		"/tip – подсказки по здоровью\n"
 	)
-	bot.send_message(message.chat.id, text)
+	send_message(message.chat.id, text)
 
 @bot.message_handler(func=lambda m: m.text in ["📈 Прогресс", "📊 Статистика"])
 @log_message
+@throttled("cheap")
 def keyboard_buttons(message):
 	if message.text == "📈 Прогресс":
-		check_progress(message)
+		show_progress(message)
 	elif message.text == "📊 Статистика":
-		stats(message)
+		show_stats(message)
 
 @bot.message_handler(commands=["set_profile"])
 @log_message
+@throttled("cheap")
 def set_profile(message):
 	users_state[message.chat.id] = {"user_id": message.chat.id}
 
@@ -299,7 +1103,7 @@ def set_profile(message):
 		types.InlineKeyboardButton("👩 Женский", callback_data="gender_f")
 	)
 
-	bot.send_message(message.chat.id, "Укажите ваш пол:", reply_markup=markup)
+	send_message(message.chat.id, "Укажите ваш пол:", reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("gender_"))
 def callback_set_gender(call):
@@ -307,48 +1111,50 @@ def callback_set_gender(call):
 	users_state[call.message.chat.id]["gender"] = gender
 
 	bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
-	bot.send_message(call.message.chat.id, f"Ваш пол: {'мужской' if gender == 'm' else 'женский'}")
-	bot.send_message(call.message.chat.id, "Введите ваш вес (кг):")
+	send_message(call.message.chat.id, f"Ваш пол: {'мужской' if gender == 'm' else 'женский'}")
+	send_message(call.message.chat.id, "Введите ваш вес (кг):")
 	bot.register_next_step_handler(call.message, set_weight)
 
 def set_weight(message):
 	try:
 		users_state[message.chat.id]["weight"] = float(message.text)
-		bot.send_message(message.chat.id, "Введите ваш рост (см):")
+		send_message(message.chat.id, "Введите ваш рост (см):")
 		bot.register_next_step_handler(message, set_height)
 	except ValueError:
-		bot.send_message(message.chat.id, "Пожалуйста, введите число (например: 70)")
+		send_message(message.chat.id, "Пожалуйста, введите число (например: 70)")
 		bot.register_next_step_handler(message, set_weight)
 
 def set_height(message):
 	try:
 		users_state[message.chat.id]["height"] = int(message.text)
-		bot.send_message(message.chat.id, "Введите ваш возраст:")
+		send_message(message.chat.id, "Введите ваш возраст:")
 		bot.register_next_step_handler(message, set_age)
 	except ValueError:
-		bot.send_message(message.chat.id, "Пожалуйста, введите целое число (например: 175)")
+		send_message(message.chat.id, "Пожалуйста, введите целое число (например: 175)")
 		bot.register_next_step_handler(message, set_height)
 
 def set_age(message):
 	try:
 		users_state[message.chat.id]["age"] = int(message.text)
-		bot.send_message(message.chat.id, "Сколько минут активности у вас в день?")
+		send_message(message.chat.id, "Сколько минут активности у вас в день?")
 		bot.register_next_step_handler(message, set_activity)
 	except ValueError:
-		bot.send_message(message.chat.id, "Пожалуйста, введите целое число (например: 30)")
+		send_message(message.chat.id, "Пожалуйста, введите целое число (например: 30)")
 		bot.register_next_step_handler(message, set_age)
 
 def set_activity(message):
 	try:
 		users_state[message.chat.id]["activity"] = int(message.text)
-		bot.send_message(message.chat.id, "В каком городе вы находитесь?")
+		send_message(message.chat.id, "В каком городе вы находитесь?")
 		bot.register_next_step_handler(message, set_city)
 	except ValueError:
-		bot.send_message(message.chat.id, "Пожалуйста, введите число (например: 60)")
+		send_message(message.chat.id, "Пожалуйста, введите число (например: 60)")
 		bot.register_next_step_handler(message, set_activity)
 
 def set_city(message):
 	users_state[message.chat.id]["city"] = message.text
+	# Если город уже встречался, id известен сразу; иначе его найдёт задача "weather"
+	users_state[message.chat.id]["city_id"] = known_city_id(message.text)
 
 	markup = types.InlineKeyboardMarkup()
 	markup.add(
@@ -356,14 +1162,14 @@ def set_city(message):
 		types.InlineKeyboardButton("⚙ Автоматически", callback_data="calories_auto")
 	)
 
-	bot.send_message(message.chat.id, "Как задать цель по калориям?", reply_markup=markup)
+	send_message(message.chat.id, "Как задать цель по калориям?", reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("calories_"))
 def callback_calories_mode(call):
 	bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
 
 	if call.data == "calories_manual":
-		bot.send_message(call.message.chat.id, "Введите желаемую норму калорий:")
+		send_message(call.message.chat.id, "Введите желаемую норму калорий:")
 		bot.register_next_step_handler(call.message, set_manual_calories)
 	else:
 		calculate_auto_calories(call.message)
@@ -371,9 +1177,10 @@ def callback_calories_mode(call):
 def set_manual_calories(message):
 	try:
 		users_state[message.chat.id]["calorie_goal"] = int(message.text)
+		users_state[message.chat.id]["calorie_mode"] = "manual"
 		finalize_profile(message)
 	except ValueError:
-		bot.send_message(message.chat.id, "Пожалуйста, введите целое число (например: 2000)")
+		send_message(message.chat.id, "Пожалуйста, введите целое число (например: 2000)")
 		bot.register_next_step_handler(message, set_manual_calories)
 
 def calculate_auto_calories(message):
@@ -381,10 +1188,12 @@ def calculate_auto_calories(message):
 	bmr = calculate_bmr(user_local["gender"], user_local["weight"], user_local["height"], user_local["age"])
 	multiplier = activity_multiplier(user_local["activity"])
 	user_local["calorie_goal"] = int(bmr * multiplier)
+	user_local["calorie_mode"] = "auto"
 	finalize_profile(message)
 
 def finalize_profile(message):
-	user_local = users_state[message.chat.id]
+	# Тренды и недавние продукты при повторной настройке профиля не теряем
+	user_local = {**(load_user(message.chat.id) or {}), **users_state[message.chat.id]}
 
 	user_local["water_goal"] = water_norm(user_local["weight"])
 	user_local["logged_water"] = 0
@@ -394,7 +1203,7 @@ def finalize_profile(message):
 
 	save_user(user_local)
 
-	bot.send_message(
+	send_message(
 		message.chat.id,
 		f"Профиль сохранён ✅\n"
 		f"🔥 Калории: {user_local['calorie_goal']} ккал\n"
@@ -403,30 +1212,31 @@ def finalize_profile(message):
 
 @bot.message_handler(commands=["log_water"])
 @log_message
+@throttled("cheap")
 def log_water(message):
-	reset_daily_if_needed(message.chat.id)
 	try:
 		amount = int(message.text.split()[1])
 	except (IndexError, ValueError):
-		bot.send_message(message.chat.id, "Использование: /log_water <мл>")
+		send_message(message.chat.id, "Использование: /log_water <мл>")
 		return
 
-	df = load_users()
-	if df.empty or message.chat.id not in df['user_id'].values:
-		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+	user = reset_daily_if_needed(message.chat.id)
+	if user is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
 		return
 
-	logged = int(df.loc[df.user_id == message.chat.id, "logged_water"].iloc[0]) + amount
-	goal = int(df.loc[df.user_id == message.chat.id, "water_goal"].iloc[0])
+	logged = int(user["logged_water"]) + amount
+	goal = int(user["water_goal"])
 
-	df.loc[df.user_id == message.chat.id, "logged_water"] = logged
-	save_df_to_s3(df, CSV_FILE)
+	user["logged_water"] = logged
+	record_trend(user, "water", amount)
+	save_user(user)
 
 	append_water_log(message.chat.id, amount)
 
 	remaining = max(goal - logged, 0)
 
-	bot.send_message(
+	send_message(
 		message.chat.id,
 		f"💧 Выпито: {logged} мл\n"
 		f"🎯 Осталось до нормы: {remaining} мл"
@@ -434,36 +1244,32 @@ def log_water(message):
 
 @bot.message_handler(commands=["log_workout"])
 @log_message
+@throttled("cheap")
 def log_workout(message):
-	reset_daily_if_needed(message.chat.id)
 	try:
 		_, train_type, minutes = message.text.split()
 		minutes = int(minutes)
 	except ValueError:
-		bot.send_message(
+		send_message(
 			message.chat.id,
 			"Использование: /log_workout <тип> <минуты>\nПример: /log_workout бег 30"
 		)
 		return
 
-	users_df = load_users()
-	if users_df.empty or message.chat.id not in users_df['user_id'].values:
-		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+	user = reset_daily_if_needed(message.chat.id)
+	if user is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
 		return
 
-	train_df = load_df_from_s3(TRAIN_CSV)
+	train_df = load_reference(TRAIN_CSV)
 	if train_df.empty:
-		bot.send_message(message.chat.id, "База тренировок недоступна")
+		send_message(message.chat.id, "База тренировок недоступна")
 		return
 
-	user_input = train_type.strip().lower()
-	train_types = train_df["train_type"].str.strip().str.lower().tolist()
-
-	matches = get_close_matches(user_input, train_types, n=1, cutoff=0.6)
+	row_number = match_reference(TRAIN_CSV, "train_type", train_type)
 
-	if matches:
-		matched_type = matches[0]
-		train = train_df[train_df.train_type.str.strip().str.lower() == matched_type].iloc[0]
+	if row_number is not None:
+		train = train_df.iloc[row_number]
 		display_train_name = train.train_type
 	else:
 		train = train_df.iloc[0]
@@ -473,16 +1279,18 @@ def log_workout(message):
 	water_needed = int(train.water_train * minutes / 60)
 	extra_water = 0
 
-	city = users_df.loc[users_df.user_id == message.chat.id, "city"].iloc[0]
-	temp = get_city_temperature(city)
+	city = user["city"]
+	temp = stored_temperature(user)
 
 	if temp and temp > 25:
 		extra_water = int(train.water_add_heat * minutes / 60)
 
 	total_water = water_needed + extra_water
 
-	users_df.loc[users_df.user_id == message.chat.id, "burned_calories"] += calories_burned
-	save_df_to_s3(users_df, CSV_FILE)
+	user["burned_calories"] = int(user["burned_calories"]) + calories_burned
+	save_user(user)
+
+	append_workout_log(message.chat.id, display_train_name, minutes, calories_burned)
 
 	response_text = (
 		f"💪🏼 {display_train_name} {minutes} минут — {calories_burned} ккал\n"
@@ -492,35 +1300,62 @@ def log_workout(message):
 	if temp:
 		response_text += f"\n🌡 Температура в городе {city}: {temp:.1f}°C"
 
-	bot.send_message(message.chat.id, response_text)
+	send_message(message.chat.id, response_text)
 
 @bot.message_handler(commands=["log_food"])
 @log_message
+@throttled("cheap")
 def log_food(message):
-	reset_daily_if_needed(message.chat.id)
-	try:
-		product_name = message.text.split(" ", 1)[1]
-	except IndexError:
-		bot.send_message(message.chat.id, "Использование: /log_food <название продукта>")
+	parts = message.text.split(" ", 1)
+	product_name = parts[1].strip() if len(parts) > 1 else ""
+
+	user = reset_daily_if_needed(message.chat.id)
+	if user is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+		return
+
+	# Без аргумента или по началу названия предлагаем недавние продукты
+	recent = rank_recent_foods(user, product_name)
+	if not product_name or (recent and not product_name.isdigit() and not parse_meal(product_name)):
+		if recent:
+			send_message(
+				message.chat.id,
+				"Недавние продукты – нажмите, чтобы записать обычную порцию:",
+				reply_markup=recent_foods_keyboard(recent, product_name)
+			)
+		else:
+			send_message(message.chat.id, "Использование: /log_food <название продукта>")
 		return
 
-	user_df = load_users()
-	if user_df.empty or message.chat.id not in user_df['user_id'].values:
-		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+	# Подсказка из недавних продуктов бесплатна, лимит считаем только для поиска
+	if not allow_command(message.chat.id, "lookup"):
 		return
 
-	# 1. Сначала обращаемся к OpenFoodFacts
-	food = get_food_info(product_name)
+	# Если указаны количества ("200г гречка, 2 яйца"), записываем весь приём пищи сразу
+	items = parse_meal(product_name)
+	if items:
+		log_meal(message.chat.id, user, items)
+		return
 
-	# 2. Затем пытаемся найти позицию в файле
-	if not food:
-		food = get_food_from_csv(product_name)
+	lookup_food(message, product_name)
+
+def lookup_food(message, product_name):
+	# Штрихкод ищем точно, без полнотекстового поиска
+	if product_name.strip().isdigit():
+		food = get_food_by_barcode(product_name.strip())
+	else:
+		# 1. Сначала обращаемся к OpenFoodFacts
+		food = cached_food_info(product_name)
+
+		# 2. Затем пытаемся найти позицию в файле
+		if not food:
+			food = get_food_from_csv(product_name)
 
 	# 3. Позиция найдена
 	if food:
 		food_state[message.chat.id] = food
 		
-		bot.send_message(
+		send_message(
 			message.chat.id,
 			f"🍽 {food['name']} — {food['calories']} ккал на 100 г.\n"
 			f"Сколько грамм вы съели?"
@@ -529,75 +1364,349 @@ def log_food(message):
 
 	# 4. Не унываем. Пользователь сам введёт калорийность
 	else:
-		bot.send_message(
+		send_message(
 			message.chat.id,
 			"Не удалось найти продукт 😕\n"
 			"Введите количество съеденных калорий:"
 		)
 		bot.register_next_step_handler(message, ask_manual_calories)
 
+# Примерный вес одной штуки: "2 яйца", "3 шт печенье"
+PIECE_GRAMS = {
+	"яйц": 55,
+	"банан": 120,
+	"яблок": 180,
+	"апельсин": 150,
+	"мандарин": 70,
+	"груш": 170,
+	"киви": 75,
+	"хлеб": 30,
+	"котлет": 80,
+	"сосиск": 50,
+	"печень": 15,
+	"конфет": 15,
+}
+DEFAULT_PIECE_GRAMS = 100
+# Число без единиц считается штуками только для штучных продуктов и только небольшое ("2 банана"),
+# иначе это граммы ("гречка 200", "банан 120")
+MAX_PIECES = 10
+# Маленькое число без единиц – скорее часть названия ("молоко 3.2", "Coca-Cola 0.5"), чем граммы
+MIN_BARE_GRAMS = 10
+# Что записываем без подтверждения: совпадение названия со справочником и правдоподобные порции
+MEAL_WORD_MATCH = 0.75
+MEAL_MAX_ITEM_GRAMS = 2000
+MEAL_MAX_ITEM_CALORIES = 2500
+UNIT_GRAMS = {
+	"г": 1, "гр": 1, "грамм": 1, "граммов": 1, "грамма": 1,
+	"кг": 1000,
+	"мл": 1,
+	"л": 1000,
+	"шт": None,
+}
+MEAL_ITEM_RE = re.compile(
+	r"^(?P<qty>\d+(?:[.,]\d+)?)\s*(?P<unit>[а-яё]+\.?)?\s+(?P<name>.+)$"
+	r"|^(?P<name2>.+?)\s+(?P<qty2>\d+(?:[.,]\d+)?)\s*(?P<unit2>[а-яё]+\.?)?$"
+)
+
+def piece_grams(name):
+	# None – продукт не штучный
+	normalized = normalize_name(name)
+	for stem, grams in PIECE_GRAMS.items():
+		if stem in normalized:
+			return grams
+	return None
+
+def parse_meal_item(text):
+	match = MEAL_ITEM_RE.match(text.strip())
+	if not match:
+		return None
+
+	qty = float((match.group("qty") or match.group("qty2")).replace(",", "."))
+	unit = (match.group("unit") or match.group("unit2") or "").rstrip(".")
+	name = (match.group("name") or match.group("name2")).strip()
+
+	# Слово после числа может оказаться не единицей, а началом названия: "2 яйца"
+	if unit and unit not in UNIT_GRAMS:
+		if match.group("qty"):
+			name = f"{unit} {name}"
+		else:
+			return None
+		unit = ""
+
+	if unit == "шт":
+		grams = qty * (piece_grams(name) or DEFAULT_PIECE_GRAMS)
+	elif unit:
+		grams = qty * UNIT_GRAMS[unit]
+	elif piece_grams(name) and qty.is_integer() and qty <= MAX_PIECES:
+		grams = qty * piece_grams(name)
+	elif qty >= MIN_BARE_GRAMS:
+		grams = qty
+	else:
+		return None
+	return {"name": name, "grams": grams}
+
+def words_match(query, name):
+	# Каждое слово запроса должно найтись в названии: "гречка" ~ "гречневая", но не "горчица"
+	name_words = re.findall(r"\w+", normalize_name(name))
+	for word in re.findall(r"\w+", normalize_name(query)):
+		if len(word) < 3:
+			continue
+		if not any(
+			len(os.path.commonprefix([word, other])) >= min(4, len(word) - 1, len(other) - 1)
+			or SequenceMatcher(None, word, other).ratio() >= MEAL_WORD_MATCH
+			for other in name_words
+		):
+			return False
+	return True
+
+def meal_item_doubtful(item, food, calories):
+	return (
+		not words_match(item["name"], food["name"])
+		or item["grams"] > MEAL_MAX_ITEM_GRAMS
+		or calories > MEAL_MAX_ITEM_CALORIES
+	)
+
+def parse_meal(text):
+	# Возвращаем None, если это обычное название продукта без количества
+	# Запятая между цифрами – это десятичная дробь ("1,5 л"), а не разделитель
+	parts = [part for part in re.split(r"(?<!\d),|,(?!\d)|[;\n]", text) if part.strip()]
+	items = [parse_meal_item(part) for part in parts]
+	if not items or any(item is None for item in items):
+		return None
+	return items
+
+def meal_lines(entries):
+	return [
+		f"• {entry['name']} {round(entry['grams'], 1):g} г — {round(entry['calories'] * entry['grams'] / 100, 1)} ккал"
+		for entry in entries
+	]
+
+def log_meal(user_id, user, items):
+	foods = resolve_foods([item["name"] for item in items])
+
+	entries = []
+	missing = []
+	doubtful = False
+	for item in items:
+		food = foods.get(item["name"])
+		if not food:
+			missing.append(item["name"])
+			continue
+		calories = round(food["calories"] * item["grams"] / 100, 1)
+		entries.append({"name": food["name"], "calories": float(food["calories"]), "grams": item["grams"]})
+		doubtful = doubtful or meal_item_doubtful(item, food, calories)
+
+	missing_line = []
+	if missing:
+		missing_line = ["Не удалось найти: " + ", ".join(missing) + ". Запишите их отдельно через /log_food"]
+
+	# Неуверенное совпадение или странная порция – сначала спрашиваем пользователя
+	if doubtful:
+		user["pending_meal"] = entries
+		save_user(user)
+		markup = types.InlineKeyboardMarkup()
+		markup.add(
+			types.InlineKeyboardButton("✅ Записать", callback_data="meal_yes"),
+			types.InlineKeyboardButton("✖ Отмена", callback_data="meal_no")
+		)
+		send_message(
+			user_id,
+			"\n".join(["Проверьте, правильно ли я понял:"] + meal_lines(entries) + missing_line),
+			reply_markup=markup
+		)
+		return
+
+	send_message(user_id, "\n".join(write_meal(user_id, user, entries) + missing_line))
+
+def write_meal(user_id, user, entries):
+	# Все позиции записываем одной записью профиля и одной записью журнала
+	if not entries:
+		return []
+	logged = [round(entry["calories"] * entry["grams"] / 100, 1) for entry in entries]
+	for entry in entries:
+		remember_food(user, entry, entry["grams"])
+	total = round(sum(logged), 1)
+	user["logged_calories"] = float(user["logged_calories"]) + total
+	record_trend(user, "calories", total)
+	save_user(user)
+	append_food_log_rows(user_id, logged)
+	return meal_lines(entries) + [f"✅ Записано: {total} ккал"]
+
+@bot.callback_query_handler(func=lambda call: call.data in ("meal_yes", "meal_no"))
+def callback_meal_confirm(call):
+	chat_id = call.message.chat.id
+	bot.edit_message_reply_markup(chat_id, call.message.message_id)
+
+	user = reset_daily_if_needed(chat_id)
+	entries = (user or {}).pop("pending_meal", None)
+	if not entries:
+		send_message(chat_id, "Нечего записывать, повторите /log_food")
+		return
+	if call.data == "meal_no":
+		save_user(user)
+		send_message(chat_id, "Не записано. Укажите граммы явно, например: /log_food 200г гречка")
+		return
+	send_message(chat_id, "\n".join(write_meal(chat_id, user, entries)))
+
+def add_logged_calories(user_id, calories, food=None, grams=None):
+	user = load_user(user_id)
+	if user is not None:
+		user["logged_calories"] = float(user["logged_calories"]) + calories
+		record_trend(user, "calories", calories)
+		if food:
+			remember_food(user, food, grams)
+		save_user(user)
+
+# Недавние продукты пользователя: name, калорийность на 100 г, последние порции, число записей и дата.
+# Ранжируем по частоте с затуханием по давности, чтобы старые привычки уступали новым
+RECENT_FOODS_LIMIT = 20
+RECENT_FOODS_SHOWN = 6
+RECENT_PORTIONS = 5
+RECENT_HALF_LIFE_DAYS = 14
+
+def recent_food_id(name):
+	return format(zlib.crc32(normalize_name(name).encode("utf-8")), "08x")
+
+def recent_food_score(entry, today):
+	age = (today - date.fromisoformat(entry["last"])).days
+	return entry["count"] * 0.5 ** (age / RECENT_HALF_LIFE_DAYS)
+
+def remember_food(user, food, grams):
+	today = date.today()
+	recent = user.get("recent_foods")
+	if not isinstance(recent, dict):
+		recent = user["recent_foods"] = {}
+
+	entry = recent.setdefault(recent_food_id(food["name"]), {"name": food["name"], "count": 0, "portions": []})
+	entry["calories"] = float(food["calories"])
+	entry["count"] += 1
+	entry["last"] = today.isoformat()
+	entry["portions"] = (entry["portions"] + [round(float(grams))])[-RECENT_PORTIONS:]
+
+	if len(recent) > RECENT_FOODS_LIMIT:
+		weakest = min(recent, key=lambda key: recent_food_score(recent[key], today))
+		del recent[weakest]
+
+def usual_portion(entry):
+	return int(np.median(entry["portions"]))
+
+def rank_recent_foods(user, prefix=""):
+	recent = user.get("recent_foods")
+	if not isinstance(recent, dict):
+		return []
+	today = date.today()
+	prefix = normalize_name(prefix)
+	matches = []
+	for key, entry in recent.items():
+		name = normalize_name(entry["name"])
+		# Префикс ищем и с начала названия, и с начала любого слова: "греч" найдёт "Каша гречневая"
+		if name.startswith(prefix) or any(word.startswith(prefix) for word in name.split()):
+			matches.append((key, entry))
+	matches.sort(key=lambda item: recent_food_score(item[1], today), reverse=True)
+	return matches[:RECENT_FOODS_SHOWN]
+
+def recent_foods_keyboard(recent, query=""):
+	markup = types.InlineKeyboardMarkup()
+	for key, entry in recent:
+		grams = usual_portion(entry)
+		calories = round(entry["calories"] * grams / 100, 1)
+		markup.add(types.InlineKeyboardButton(
+			f"{entry['name'][:32]} · {grams} г · {calories} ккал",
+			callback_data=f"recent_{key}"
+		))
+	# Если нужен другой продукт, поиск запускается по тому же запросу
+	search = f"recentfind_{query}"
+	if query and len(search.encode("utf-8")) <= 64:
+		markup.add(types.InlineKeyboardButton(f"🔎 Искать «{query}»", callback_data=search))
+	return markup
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("recent_"))
+def callback_recent_food(call):
+	chat_id = call.message.chat.id
+	bot.edit_message_reply_markup(chat_id, call.message.message_id)
+
+	user = reset_daily_if_needed(chat_id)
+	entry = (user or {}).get("recent_foods", {}).get(call.data[len("recent_"):])
+	if entry is None:
+		send_message(chat_id, "Продукт не найден, запишите его через /log_food <название>")
+		return
+
+	# Всё нужное уже лежит в профиле – никаких внешних запросов
+	grams = usual_portion(entry)
+	calories = round(entry["calories"] * grams / 100, 1)
+	user["logged_calories"] = float(user["logged_calories"]) + calories
+	record_trend(user, "calories", calories)
+	remember_food(user, entry, grams)
+	save_user(user)
+	append_food_log(chat_id, calories)
+
+	send_message(chat_id, f"✅ Записано: {entry['name']} {grams} г — {calories} ккал")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("recentfind_"))
+@throttled("lookup")
+def callback_recent_find(call):
+	bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
+	lookup_food(call.message, call.data[len("recentfind_"):])
+
 def ask_food_weight(message):
 	try:
 		grams = float(message.text)
 	except ValueError:
-		bot.send_message(message.chat.id, "Введите число (граммы):")
+		send_message(message.chat.id, "Введите число (граммы):")
 		bot.register_next_step_handler(message, ask_food_weight)
 		return
 
 	food = food_state.pop(message.chat.id, None)
 	if not food:
-		bot.send_message(message.chat.id, "Сессия устарела. Начните заново.")
+		send_message(message.chat.id, "Сессия устарела. Начните заново.")
 		return
 
 	calories = round(food["calories"] * grams / 100, 1)
 
-	df = load_users()
-	df.loc[df.user_id == message.chat.id, "logged_calories"] += calories
-	save_df_to_s3(df, CSV_FILE)
+	add_logged_calories(message.chat.id, calories, food, grams)
 
 	append_food_log(message.chat.id, calories)
 
-	bot.send_message(message.chat.id, f"✅ Записано: {calories} ккал")
+	send_message(message.chat.id, f"✅ Записано: {calories} ккал")
 
 def ask_manual_calories(message):
 	try:
 		calories = float(message.text)
 	except ValueError:
-		bot.send_message(message.chat.id, "Введите число (ккал):")
+		send_message(message.chat.id, "Введите число (ккал):")
 		bot.register_next_step_handler(message, ask_manual_calories)
 		return
 
-	df = load_users()
-	df.loc[df.user_id == message.chat.id, "logged_calories"] += calories
-	save_df_to_s3(df, CSV_FILE)
+	add_logged_calories(message.chat.id, calories)
 
 	append_food_log(message.chat.id, calories)
 
-	bot.send_message(message.chat.id, f"✅ Записано вручную: {calories} ккал")
+	send_message(message.chat.id, f"✅ Записано вручную: {calories} ккал")
 
 @bot.message_handler(commands=["check_progress"])
 @log_message
+@throttled("cheap")
 def check_progress(message):
-	reset_daily_if_needed(message.chat.id)
-	df = load_users()
-	if df.empty or message.chat.id not in df['user_id'].values:
-		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
-		return
+	show_progress(message)
 
-	user_local = df[df.user_id == message.chat.id].iloc[0]
+# Кнопки клавиатуры вызывают эти функции напрямую: сообщение уже учтено и прошло лимит у keyboard_buttons
+def show_progress(message):
+	user_local = reset_daily_if_needed(message.chat.id)
+	if user_local is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+		return
 
-	water_logged = float(user_local.logged_water)
-	water_goal = float(user_local.water_goal)
+	water_logged = float(user_local["logged_water"])
+	water_goal = float(user_local["water_goal"])
 	water_left = max(water_goal - water_logged, 0)
 
-	calories_logged = float(user_local.logged_calories)
-	calorie_goal = float(user_local.calorie_goal)
+	calories_logged = float(user_local["logged_calories"])
+	calorie_goal = float(user_local["calorie_goal"])
 	calories_left = max(calorie_goal - calories_logged, 0)
 
-	burned = float(user_local.burned_calories)
+	burned = float(user_local["burned_calories"])
 
-	bot.send_message(
-		message.chat.id,
+	text = (
 		"📊 Прогресс:\n\n"
 		"💧 Вода:\n"
 		f"- Выпито: {int(water_logged)} мл из {int(water_goal)} мл\n"
@@ -608,189 +1717,595 @@ def check_progress(message):
 		f"🏃‍♂️ Сожжено: {int(burned)} ккал"
 	)
 
+	# Сравнение со средним берём из готовых агрегатов, журналы не читаем
+	trends = user_local.get("trends")
+	if isinstance(trends, dict):
+		water_delta = trend_delta_text(trend_summary(trends["water"]), "мл")
+		calories_delta = trend_delta_text(trend_summary(trends["calories"]), "ккал")
+		if water_delta or calories_delta:
+			text += "\n\n📈 Сегодня:"
+		if water_delta:
+			text += f"\n- Вода {water_delta}"
+		if calories_delta:
+			text += f"\n- Калории {calories_delta}"
+
+	send_message(message.chat.id, text)
+
+@bot.message_handler(commands=["trends"])
+@log_message
+@throttled("cheap")
+def trends_command(message):
+	user_local = reset_daily_if_needed(message.chat.id)
+	if user_local is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+		return
+
+	user_trends = user_local.get("trends")
+	if not isinstance(user_trends, dict):
+		send_message(message.chat.id, "Пока нет данных. Записывайте воду и еду, и здесь появится статистика")
+		return
+
+	text = "📈 Тренды:\n"
+	for metric, title, unit in [("water", "💧 Вода", "мл"), ("calories", "🔥 Калории", "ккал")]:
+		summary = trend_summary(user_trends[metric])
+		text += f"\n{title}:\n- Сегодня: {int(summary['today'])} {unit}\n"
+		if summary["mean7"] is not None:
+			text += (
+				f"- Среднее за 7 дней: {int(summary['mean7'])} {unit}\n"
+				f"- Среднее за 30 дней: {int(summary['mean30'])} {unit}\n"
+				f"- Сглаженное (EWMA): {int(summary['ewma'])} {unit}\n"
+			)
+		text += f"- Дней подряд с выполненной нормой: {summary['streak']}\n"
+
+	send_message(message.chat.id, text)
+
 
 @bot.message_handler(commands=["profile"])
 @log_message
+@throttled("cheap")
 def profile(message):
-	reset_daily_if_needed(message.chat.id)
-	df = load_users()
-	if df.empty or message.chat.id not in df['user_id'].values:
-		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+	user_local = reset_daily_if_needed(message.chat.id)
+	if user_local is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
 		return
 
-	user_local = df[df.user_id == message.chat.id].iloc[0]
 	user_tg = message.from_user
-	if user_local.gender == "m":
+	if user_local["gender"] == "m":
 		gender_send = "Мужской"
 	else:
 		gender_send = "Женский"
-	bot.send_message(
+	send_message(
 		message.chat.id,
 		f"Информация о {user_tg.first_name}\n"
 		f"📋 Пол: {gender_send}\n"
-		f"⚖️ Вес: {user_local.weight} кг\n"
-		f"📏 Рост: {user_local.height} см\n"
-		f"🎂 Возраст: {user_local.age} лет\n"
-		f"🏃 Активность: {user_local.activity} мин/день\n"
-		f"🏙️ Город: {user_local.city}"
+		f"⚖️ Вес: {user_local['weight']} кг\n"
+		f"📏 Рост: {user_local['height']} см\n"
+		f"🎂 Возраст: {user_local['age']} лет\n"
+		f"🏃 Активность: {user_local['activity']} мин/день\n"
+		f"🏙️ Город: {user_local['city']}"
 	)
 
 
 @bot.message_handler(commands=["stats"])
 @log_message
+@throttled("cheap")
 def stats(message):
+	show_stats(message)
+
+@throttled("render")
+def show_stats(message):
 	user_id = message.chat.id
-	today_start = datetime.combine(date.today(), time.min)
 
-	users_df = load_users()
-	if users_df.empty or user_id not in users_df['user_id'].values:
-		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+	user = load_user(user_id)
+	if user is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
 		return
 
-	water_goal = float(users_df.loc[users_df.user_id == user_id, "water_goal"].iloc[0])
-	calorie_goal = float(users_df.loc[users_df.user_id == user_id, "calorie_goal"].iloc[0])
+	water_goal = float(user["water_goal"])
+	calorie_goal = float(user["calorie_goal"])
 
 	# График по воде
-	water_df = load_df_from_s3(WATER_LOG_CSV)
-	if not water_df.empty:
-		water_df["datetime"] = pd.to_datetime(water_df["datetime"])
-		water_df = water_df[
-			(water_df.user_id == user_id) &
-			(water_df.datetime >= today_start)
-		]
-		
-		if not water_df.empty:
-			water_df["step"] = range(1, len(water_df) + 1)
-			water_df["cumulative"] = water_df.amount_ml.cumsum()
-			
-			def plot_water():
-				plt.figure(figsize=(10, 6))
-				plt.plot(
-					water_df["step"],
-					water_df["cumulative"],
-					marker="o",
-					linewidth=2
-				)
-				plt.axhline(water_goal, color='r', linestyle="--", label=f'Цель: {water_goal} мл')
-				plt.title("Прогресс выпитой воды за день")
-				plt.xticks(water_df["step"])
-				plt.xlabel("Приёмы воды")
-				plt.ylabel("мл")
-				plt.legend()
-				plt.grid(True, alpha=0.3)
-				plt.tight_layout()
-			
-			send_plot_as_photo(message.chat.id, plot_water)
+	series = today_series(WATER_LOG_CSV, user_id, "amount_ml")
+	if series is not None:
+		if len(series[0]):
+			send_chart(
+				message.chat.id, *series, water_goal,
+				"Прогресс выпитой воды за день", "Приёмы воды", "мл", "мл"
+			)
 		else:
-			bot.send_message(message.chat.id, "За сегодня нет записей о воде")
+			send_message(message.chat.id, "За сегодня нет записей о воде")
 
 	# График по калориям
-	food_df = load_df_from_s3(FOOD_LOG_CSV)
-	if not food_df.empty:
-		food_df["datetime"] = pd.to_datetime(food_df["datetime"])
-		food_df = food_df[
-			(food_df.user_id == user_id) &
-			(food_df.datetime >= today_start)
-		]
-		
-		if not food_df.empty:
-			food_df["step"] = range(1, len(food_df) + 1)
-			food_df["cumulative"] = food_df.calories.cumsum()
-			
-			def plot_food():
-				plt.figure(figsize=(10, 6))
-				plt.plot(
-					food_df["step"],
-					food_df["cumulative"],
-					marker="o",
-					linewidth=2
-				)
-				plt.axhline(calorie_goal, color='r', linestyle="--", label=f'Цель: {calorie_goal} ккал')
-				plt.title("Прогресс по калориям за день")
-				plt.xticks(food_df["step"])
-				plt.xlabel("Приёмы еды")
-				plt.ylabel("ккал")
-				plt.legend()
-				plt.grid(True, alpha=0.3)
-				plt.tight_layout()
-			
-			send_plot_as_photo(message.chat.id, plot_food)
+	series = today_series(FOOD_LOG_CSV, user_id, "calories")
+	if series is not None:
+		if len(series[0]):
+			send_chart(
+				message.chat.id, *series, calorie_goal,
+				"Прогресс по калориям за день", "Приёмы еды", "ккал", "ккал"
+			)
 		else:
-			bot.send_message(message.chat.id, "За сегодня нет записей о еде")
+			send_message(message.chat.id, "За сегодня нет записей о еде")
 
-@bot.message_handler(commands=["tip"])
+@bot.message_handler(commands=["export"])
 @log_message
-def tip(message):
-	reset_daily_if_needed(message.chat.id)
+@throttled("render")
+def export(message):
+	args = message.text.split()[1:]
+	zipped = "zip" in args
+	dates = [arg for arg in args if arg != "zip"]
+	try:
+		parsed = [date.fromisoformat(arg) for arg in dates[:2]]
+	except ValueError:
+		send_message(message.chat.id, "Использование: /export [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [zip]")
+		return
 
-	df = load_users()
-	if df.empty or message.chat.id not in df['user_id'].values:
-		bot.send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+	date_from = parsed[0].isoformat() if len(parsed) > 0 else None
+	# Верхняя граница включительно: берём всё до начала следующего дня
+	date_to = (parsed[1] + timedelta(days=1)).isoformat() if len(parsed) > 1 else None
+
+	if load_user(message.chat.id) is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
 		return
 
-	user_local = df[df.user_id == message.chat.id].iloc[0]
+	with tempfile.TemporaryFile() as tmp:
+		if zipped:
+			with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as archive:
+				with archive.open("history.csv", "w") as raw:
+					with io.TextIOWrapper(raw, encoding="utf-8", newline="") as out:
+						rows = export_user_history(message.chat.id, out, date_from, date_to)
+		else:
+			out = io.TextIOWrapper(tmp, encoding="utf-8", newline="")
+			rows = export_user_history(message.chat.id, out, date_from, date_to)
+			out.flush()
+			out.detach()
+
+		if not rows:
+			send_message(message.chat.id, "За выбранный период записей нет")
+			return
+
+		tmp.seek(0)
+		file_name = "history.zip" if zipped else "history.csv"
+		# Ждём отправки, пока временный файл ещё открыт
+		wait([send_document(message.chat.id, tmp, visible_file_name=file_name, caption=f"📁 Записей: {rows}")])
+
+# Индекс для /tip: все пары «продукт × порция», отсортированные по калорийности порции.
+# Порции, которые помещаются в остаток нормы, находятся двумя бинарными поисками
+PORTION_PRESETS = np.array([100, 150, 200, 250, 300])
+TIP_COUNT = 3
+TIP_MIN_SHARE = 0.3  # порция должна закрывать хотя бы такую долю остатка
+
+def build_tip_index(food_df):
+	per_100g = food_df["energy_kcal_100g"].to_numpy(dtype=float)
+	rows = np.repeat(np.arange(len(food_df)), len(PORTION_PRESETS))
+	grams = np.tile(PORTION_PRESETS, len(food_df))
+	calories = per_100g[rows] * grams / 100
+	order = np.argsort(calories, kind="stable")
+	return {
+		"names": food_df["product_name"].tolist(),
+		"per_100g": per_100g,
+		"rows": rows[order],
+		"grams": grams[order],
+		"calories": calories[order],
+	}
+
+def tip_index():
+	index = reference_cache.get((HEALTH_FOOD_CSV, "tip_index"))
+	if index is None:
+		food_df = load_reference(HEALTH_FOOD_CSV)
+		if food_df.empty:
+			return None
+		index = reference_cache[(HEALTH_FOOD_CSV, "tip_index")] = build_tip_index(food_df)
+	return index
+
+def pick_tips(index, delta, seed, turn, count=TIP_COUNT):
+	calories = index["calories"]
+	end = np.searchsorted(calories, delta, side="right")
+	start = np.searchsorted(calories, delta * TIP_MIN_SHARE)
+	if end - start < count:
+		# Остаток совсем маленький: берём самые сытные порции, которые ещё помещаются
+		start = max(end - count * len(PORTION_PRESETS), 0)
+	size = end - start
+	if size <= 0:
+		return []
+
+	# Шаг, взаимно простой с размером окна, обходит все варианты, прежде чем повторить первый.
+	# Начальная точка своя у каждого пользователя и дня
+	step = max(int(size * 0.618), 1) | 1
+	while gcd(step, size) != 1:
+		step += 2
+	offset = zlib.crc32(seed.encode("utf-8")) % size
+
+	# Каждому /tip достаётся своё окно из count * 2 позиций: повторы одного блюда пропускаем,
+	# а окна соседних подсказок не пересекаются
+	picked = []
+	seen_rows = set()
+	window = count * 2
+	for k in range(turn * window, turn * window + min(size, window)):
+		position = start + (offset + k * step) % size
+		row = index["rows"][position]
+		if row in seen_rows:
+			continue
+		seen_rows.add(row)
+		picked.append((
+			index["names"][row],
+			int(index["grams"][position]),
+			round(float(calories[position]), 1),
+			round(float(index["per_100g"][row]), 1),
+		))
+		if len(picked) == count:
+			break
+	return picked
+
+MAX_WORKOUT_MINUTES = 90
+WORKOUT_SUGGESTIONS = 3
+HEAT_THRESHOLD = 25  # выше этой температуры добавляем воду по water_add_heat, как в /log_workout
+
+def suggest_workouts(train_df, excess, temp=None, count=WORKOUT_SUGGESTIONS):
+	# Один векторный проход по всему справочнику тренировок: сколько минут и воды нужно на каждую
+	rate = train_df["calorie_consumption"].to_numpy(dtype=float)
+	water_rate = train_df["water_train"].to_numpy(dtype=float)
+	if temp is not None and temp > HEAT_THRESHOLD:
+		water_rate = water_rate + train_df["water_add_heat"].to_numpy(dtype=float)
+
+	with np.errstate(divide="ignore"):
+		minutes = np.ceil(excess / rate * 60)
+	fits = minutes <= MAX_WORKOUT_MINUTES
+	if fits.any():
+		# Самые короткие тренировки, которые укладываются в лимит
+		candidates = np.flatnonzero(fits)
+		chosen = candidates[np.argsort(minutes[candidates], kind="stable")[:count]]
+	else:
+		# Не укладывается ничего – предлагаем самые интенсивные на полные 90 минут
+		chosen = np.argsort(-rate, kind="stable")[:count]
+	minutes = np.minimum(minutes, MAX_WORKOUT_MINUTES)
+
+	names = train_df["train_type"].to_numpy()
+	suggestions = [
+		(names[i], int(minutes[i]), int(rate[i] * minutes[i] / 60), int(water_rate[i] * minutes[i] / 60))
+		for i in chosen
+	]
+	return suggestions, bool(fits.any())
 
-	calories_logged = float(user_local.logged_calories)
-	calorie_goal = float(user_local.calorie_goal)
+@bot.message_handler(commands=["tip"])
+@log_message
+@throttled("cheap")
+def tip(message):
+	user_local = reset_daily_if_needed(message.chat.id)
+	if user_local is None:
+		send_message(message.chat.id, "Сначала заполните профиль: /set_profile")
+		return
+
+	calories_logged = float(user_local["logged_calories"])
+	calorie_goal = float(user_local["calorie_goal"])
 
 	delta = calorie_goal - calories_logged
 
 	# Когда осталось место в ежедневной норме калорий
 	if delta > 0:
-		food_df = load_df_from_s3(HEALTH_FOOD_CSV)
-		if food_df.empty:
-			bot.send_message(message.chat.id, "База здоровых продуктов недоступна")
+		index = tip_index()
+		if index is None:
+			send_message(message.chat.id, "База здоровых продуктов недоступна")
 			return
-		
-		sample_size = min(3, len(food_df))
-		recommendations = food_df.sample(sample_size)
-		
+
+		# Номер подсказки за день растёт с каждым /tip, поэтому варианты не повторяются
+		today = user_local["last_reset_date"]
+		turn = (user_local.get("tip_turn") or 0) if user_local.get("tip_day") == today else 0
+		tips = pick_tips(index, delta, f"{message.chat.id}:{today}", turn)
+		if not tips:
+			# Остаток меньше самой маленькой порции из справочника
+			send_message(message.chat.id, f"🎯 До нормы осталось совсем немного: {round(delta, 1):g} ккал. Можно больше ничего не есть")
+			return
+		user_local["tip_day"] = today
+		user_local["tip_turn"] = turn + 1
+		save_user(user_local)
+
 		text = (
 			"🥗 Вам можно ещё поесть!\n"
 			f"До цели осталось: {int(delta)} ккал\n\n"
 			"Рекомендации:\n"
 		)
-		
-		for _, row in recommendations.iterrows():
-			text += f"• {row.product_name} — {row.energy_kcal_100g} ккал / 100 г\n"
-		
-		bot.send_message(message.chat.id, text)
+
+		for name, grams, calories, per_100g in tips:
+			text += f"• {name} — {grams} г, {calories} ккал ({per_100g} ккал / 100 г)\n"
+
+		send_message(message.chat.id, text)
 		return
 
 	# Когда мы переели, то нужно предложить способ сжечь калории
 	excess = abs(delta)
+	train_df = load_reference(TRAIN_CSV)
+	if train_df.empty:
+		send_message(message.chat.id, "База тренировок недоступна")
+		return
 
-	if excess <= 500:
-		burn_rate = 350  # Сжигаемые калории за час тренировки
-		activity = "🚶‍♂️ Быстрая ходьба"
+	temp = stored_temperature(user_local)
+	suggestions, fits = suggest_workouts(train_df, excess, temp)
+
+	text = f"🔥 Вы превысили норму на {int(excess)} ккал\n"
+	if fits:
+		text += f"Любая из тренировок сожжёт лишнее не больше чем за {MAX_WORKOUT_MINUTES} минут:\n"
 	else:
-		burn_rate = 680
-		activity = "🏃‍♂️ Бег"
+		text += f"За {MAX_WORKOUT_MINUTES} минут всё не сжечь, но эти тренировки помогут больше всего:\n"
+	for name, minutes, calories, water in suggestions:
+		text += f"• {name} — {minutes} мин, {calories} ккал, выпейте {water} мл\n"
+	if temp is not None and temp > HEAT_THRESHOLD:
+		text += f"🌡 В городе {temp:.0f}°C, воды нужно больше обычного"
 
-	minutes = int((excess / burn_rate) * 60)
-	minutes = min(minutes, 90)
+	send_message(message.chat.id, text)
 
-	bot.send_message(
+@bot.message_handler(commands=["profiling"])
+@log_message
+@throttled("cheap")
+def profiling_command(message):
+	if message.chat.id not in ADMIN_IDS:
+		return
+
+	# /profiling off | /profiling cprofile|sample [доля] [порог_мс]
+	args = message.text.split()[1:]
+	try:
+		if args and args[0] == "off":
+			profiling.configure(mode="")
+		elif args:
+			profiling.configure(
+				mode=args[0],
+				sample_rate=args[1] if len(args) > 1 else None,
+				slow_ms=args[2] if len(args) > 2 else None
+			)
+	except ValueError:
+		send_message(message.chat.id, "Использование: /profiling off | cprofile|sample [доля] [порог_мс]")
+		return
+
+	if args and PROFILE_SHARED:
+		save_profile_settings()
+	scope = (
+		f"Другие инстансы применят режим в течение {PROFILE_SETTINGS_SECONDS} с" if PROFILE_SHARED
+		else "Режим изменён только на этом инстансе (PROFILE_SHARED=0)"
+	)
+	send_message(
 		message.chat.id,
-		f"🔥 Вы превысили норму на {int(excess)} ккал\n"
-		f"{activity}\n"
-		f"⏱ Рекомендуемое время: {minutes} минут"
+		f"Профилирование: {profiling.describe()}\n"
+		f"{scope}\n"
+		f"Задержки этого инстанса:\n"
+		f"Ответ вебхука: {latency_summary('ack')}\n"
+		f"Полная обработка: {latency_summary('end_to_end')}"
+	)
+
+def save_profile_settings():
+	settings = {key: profiling.settings[key] for key in ("mode", "sample_rate", "slow_ms")}
+	upload_to_s3(PROFILE_SETTINGS_JSON, json.dumps(settings), 'application/json')
+	profile_settings_cache["loaded"] = datetime.now().timestamp()
+
+def refresh_profile_settings():
+	# Без сохранённого режима остаются значения из переменных окружения
+	if not PROFILE_SHARED:
+		return
+	now = datetime.now().timestamp()
+	if now - profile_settings_cache["loaded"] < PROFILE_SETTINGS_SECONDS:
+		return
+	profile_settings_cache["loaded"] = now
+	settings = load_json_from_s3(PROFILE_SETTINGS_JSON)
+	try:
+		profiling.configure(**settings)
+	except (ValueError, TypeError) as e:
+		logger.error(f"Bad profiling settings: {e}")
+
+def send_reminders(reminders):
+	futures = [send_message(chat_id, text) for chat_id, text in reminders]
+	outbound.drain()
+	return sum(1 for future in futures if future.exception() is None)
+
+def timer_handler(event, context):
+	# Точка входа для триггера-таймера. В payload перечисляем задачи:
+	# "reset", "remind", "recompute_goals", "recompute_goals_dry" (только показать разницу),
+	# "migrate_users" (разбить старый users.csv), "export_users" (выгрузить всех в один CSV)
+	# и "weather" (обновить температуры во всех городах пользователей)
+	try:
+		payload = event["messages"][0]["details"].get("payload") or "reset"
+	except (KeyError, IndexError, TypeError):
+		payload = "reset"
+	tasks = [task.strip() for task in payload.split(",") if task.strip()]
+
+	today = date.today().isoformat()
+	result = {}
+	if "migrate_users" in tasks:
+		result["migrated"] = migrate_users_csv()
+
+	df = load_users()
+	before = user_records(df)
+	changed = set()
+
+	if "reset" in tasks:
+		reset_ids = reset_daily_all(df, today)
+		result["reset"] = len(reset_ids)
+		changed.update(reset_ids)
+
+	if "recompute_goals" in tasks or "recompute_goals_dry" in tasks:
+		dry_run = "recompute_goals" not in tasks
+		diff = recompute_goals(df, dry_run=dry_run)
+		result["goals_changed"] = len(diff)
+		if not diff.empty:
+			logger.info("Изменения целей%s:\n%s", " (dry run)" if dry_run else "", diff.head(50).to_string(index=False))
+			if not dry_run:
+				changed.update(diff["user_id"])
+
+	if "weather" in tasks:
+		city_changed = prefetch_weather(df)
+		result["city_ids_set"] = len(city_changed)
+		changed.update(city_changed)
+
+	# Перезаписываем только изменившихся пользователей и только изменённые поля
+	if changed:
+		result["saved"] = save_users(df, changed, before)
+
+	if "export_users" in tasks:
+		save_df_to_s3(df, USERS_EXPORT_CSV, index=True)
+		result["exported"] = len(df)
+
+	if "remind" in tasks:
+		result["reminded"] = send_reminders(collect_water_reminders(df, today))
+
+	logger.info("Задачи по таймеру %s: %s, очередь отправки: %s", tasks, result, outbound.stats())
+	return {
+		'statusCode': 200,
+		'body': json.dumps(result)
+	}
+
+def claim_update(update_id):
+	# True – обновление пришло впервые и его нужно обработать, False – это повторная доставка
+	now = datetime.now().timestamp()
+	first_seen = seen_updates.get(update_id)
+	if first_seen is not None and now - first_seen < DEDUP_TTL_SECONDS:
+		metrics.inc("bot_updates_duplicate_total", layer="memory")
+		return False
+	seen_updates[update_id] = now
+	seen_updates.move_to_end(update_id)
+	while len(seen_updates) > DEDUP_MEMORY_SIZE:
+		seen_updates.popitem(last=False)
+
+	if not DEDUP_SHARED:
+		return True
+
+	# Повтор может прийти на другой инстанс, поэтому занимаем ключ в бакете условной записью
+	key = f"{UPDATES_PREFIX}{update_id}"
+	try:
+		metrics.inc("bot_s3_operations_total", op="put_if_absent")
+		s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=str(now), IfNoneMatch="*")
+		return True
+	except ClientError as e:
+		if e.response.get("Error", {}).get("Code") not in ("PreconditionFailed", "412"):
+			logger.error(f"Dedup error for update {update_id}: {e}")
+			return True
+	try:
+		claimed_at = float(download_from_s3(key) or 0)
+	except ValueError:
+		claimed_at = 0
+	if now - claimed_at < DEDUP_TTL_SECONDS:
+		metrics.inc("bot_updates_duplicate_total", layer="bucket")
+		return False
+	# Старый ключ, который ещё не удалило правило жизненного цикла бакета
+	upload_to_s3(key, str(now), 'text/plain')
+	return True
+
+def release_update(update_id):
+	# Если обработка упала, даём Telegram доставить обновление ещё раз
+	seen_updates.pop(update_id, None)
+	if DEDUP_SHARED:
+		try:
+			metrics.inc("bot_s3_operations_total", op="delete")
+			s3_client.delete_object(Bucket=BUCKET_NAME, Key=f"{UPDATES_PREFIX}{update_id}")
+		except Exception as e:
+			logger.error(f"Dedup release error for update {update_id}: {e}")
+
+def update_done(update_id):
+	# Пачку из очереди после ошибки доставят целиком, уже обработанные обновления пропускаем
+	if update_id in done_updates:
+		return True
+	return DEDUP_SHARED and download_from_s3(f"{UPDATES_PREFIX}{update_id}.done", missing_ok=True) is not None
+
+def mark_update_done(update_id):
+	done_updates[update_id] = True
+	while len(done_updates) > DEDUP_MEMORY_SIZE:
+		done_updates.popitem(last=False)
+	if DEDUP_SHARED:
+		upload_to_s3(f"{UPDATES_PREFIX}{update_id}.done", "", 'text/plain')
+
+def record_latency(kind, seconds):
+	latency_stats[kind].append(seconds)
+	metrics.observe("bot_webhook_seconds", seconds, stage=kind)
+	logger.info("Задержка %s: %.0f мс", kind, seconds * 1000)
+
+def latency_summary(kind):
+	values = latency_stats[kind]
+	if not values:
+		return "нет данных"
+	p50, p95 = np.percentile(list(values), [50, 95]) * 1000
+	return f"p50={p50:.0f} мс, p95={p95:.0f} мс ({len(values)})"
+
+def process_update(update_dict, received_at, capture=False):
+	refresh_profile_settings()
+	update = telebot.types.Update.de_json(update_dict)
+	webhook_reply["capture"] = capture
+	try:
+		with metrics.timer("bot_update_seconds"):
+			profiling.run_profiled("update", bot.process_new_updates, [update])
+	except Exception:
+		flush_reply()
+		raise
+	finally:
+		reply = take_reply()
+		# Более ранние сообщения должны дойти до того, как Telegram выполнит ответ вебхука
+		if not outbound.drain(SEND_DRAIN_TIMEOUT):
+			logger.warning("Очередь отправки не успела опустеть: %s", outbound.stats())
+		record_latency("end_to_end", datetime.now().timestamp() - received_at)
+	return reply
+
+def enqueue_update(update_dict, received_at):
+	sqs_client.send_message(
+		QueueUrl=UPDATES_QUEUE_URL,
+		MessageBody=json.dumps({"update": update_dict, "received_at": received_at})
 	)
 
 def handler(event, context):
+	received_at = datetime.now().timestamp()
 	try:
 		if event.get("httpMethod") == "POST":
 			body = event.get('body', '')
 			if not body:
 				return {'statusCode': 400, 'body': 'Empty body'}
 
-			update_dict = json.loads(body)
-			update = telebot.types.Update.de_json(update_dict)
-			bot.process_new_updates([update])
+			try:
+				update_dict = json.loads(body)
+			except ValueError:
+				return {'statusCode': 400, 'body': 'Invalid JSON'}
+			if not isinstance(update_dict, dict) or "update_id" not in update_dict:
+				return {'statusCode': 400, 'body': 'Not an update'}
+
+			update_id = update_dict["update_id"]
+			if not claim_update(update_id):
+				dedup_stats["duplicates"] += 1
+				logger.info("Повторная доставка обновления %s, всего повторов: %s", update_id, dedup_stats["duplicates"])
+				return {
+					'statusCode': 200,
+					'body': json.dumps({'status': 'duplicate'})
+				}
+
+			if sqs_client is not None:
+				# Быстрое подтверждение: обработку выполнит queue_handler по триггеру очереди
+				try:
+					enqueue_update(update_dict, received_at)
+				except Exception:
+					release_update(update_id)
+					raise
+				record_latency("ack", datetime.now().timestamp() - received_at)
+				return {
+					'statusCode': 200,
+					'body': json.dumps({'status': 'queued'})
+				}
+
+			try:
+				reply = process_update(update_dict, received_at, capture=WEBHOOK_REPLY)
+			except Exception:
+				# Telegram получит ошибку и доставит обновление ещё раз
+				release_update(update_id)
+				raise
+			record_latency("ack", datetime.now().timestamp() - received_at)
+			if reply is not None:
+				return {
+					'statusCode': 200,
+					'headers': {'Content-Type': 'application/json'},
+					'body': json.dumps(reply, ensure_ascii=False)
+				}
 			return {
 				'statusCode': 200,
 				'body': json.dumps({'status': 'OK'})
 			}
+		elif (event.get("path") or event.get("url") or "").split("?")[0].endswith("/metrics"):
+			# Метрики своего инстанса; каждый инстанс функции считает отдельно
+			return {
+				'statusCode': 200,
+				'headers': {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+				'body': metrics.render()
+			}
 		else:
 			return {
 				'statusCode': 200,
@@ -801,4 +2316,30 @@ def handler(event, context):
 		return {
 			'statusCode': 500,
 			'body': json.dumps({'error': str(e)})
-		}
\ No newline at end of file
+		}
+
+def queue_handler(event, context):
+	# Точка входа для триггера Message Queue: обрабатываем обновления, которые handler положил в очередь
+	messages = event.get("messages", [])
+	processed = skipped = failed = 0
+	for message in messages:
+		try:
+			item = json.loads(message["details"]["message"]["body"])
+			update_id = item["update"].get("update_id")
+			if update_done(update_id):
+				skipped += 1
+				continue
+			process_update(item["update"], item["received_at"])
+			mark_update_done(update_id)
+			processed += 1
+		except Exception as e:
+			failed += 1
+			logger.error(f"Queued update error: {e}")
+	# Ключ дедупликации не снимаем: handler уже ответил Telegram, повтор обновления придёт только из очереди.
+	# Ошибка функции оставляет сообщения в очереди, после maxReceiveCount они уходят в dead-letter очередь
+	if failed:
+		raise RuntimeError(f"Не обработано обновлений из очереди: {failed} из {len(messages)}")
+	return {
+		'statusCode': 200,
+		'body': json.dumps({'processed': processed, 'skipped': skipped})
+	}
\ No newline at end of file